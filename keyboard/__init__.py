@@ -83,8 +83,10 @@ version = '0.13.4'
 
 import re as _re
 import itertools as _itertools
+import bisect as _bisect
 import collections as _collections
-from threading import Thread as _Thread, Lock as _Lock
+from threading import Thread as _Thread, Lock as _Lock, RLock as _RLock, Condition as _Condition
+from contextlib import contextmanager as _contextmanager
 import time as _time
 # Python2... Buggy on time changes and leap seconds, but no other good option (https://stackoverflow.com/questions/1205722/how-do-i-get-monotonic-time-durations-in-python).
 _time.monotonic = getattr(_time, 'monotonic', None) or _time.time
@@ -128,7 +130,9 @@ else:
     raise OSError("Unsupported platform '{}'".format(_platform.system()))
 
 from ._keyboard_event import KEY_DOWN, KEY_UP, KeyboardEvent
-from ._generic import GenericListener as _GenericListener
+from ._event_batch import EventBatch
+from ._event_file import save_events, load_events
+from ._generic import GenericListener as _GenericListener, CallbackExecutor, HandlerStats as _HandlerStats, timer as _timer, describe as _describe
 from ._canonical_names import all_modifiers, sided_modifiers, normalize_name
 
 _modifier_scan_codes = set()
@@ -144,10 +148,361 @@ def is_modifier(key):
             _modifier_scan_codes.update(*scan_codes)
         return key in _modifier_scan_codes
 
-_pressed_events_lock = _Lock()
-_pressed_events = {}
+# Sided modifiers (e.g. left and right ctrl) are matched by class, so a
+# hotkey like 'ctrl+alt+shift+a' is registered once instead of once per
+# combination of sides. Class ids are above any scan code.
+_MODIFIER_CLASS_BASE = 0x100000
+_modifier_classes = {} # scan code -> class id
+_modifier_class_members = {} # class id -> scan codes
+_modifier_class_ids = {} # frozenset of scan codes -> class id
+def _update_modifier_classes():
+    """
+    Assigns a class to the scan codes of each sided modifier, unless they
+    already belong to another class.
+    """
+    _modifier_classes.clear()
+    _modifier_class_members.clear()
+    _modifier_class_ids.clear()
+    for i, name in enumerate(sorted(sided_modifiers)):
+        scan_codes = key_to_scan_codes(name, False)
+        if len(scan_codes) < 2 or any(scan_code in _modifier_classes for scan_code in scan_codes):
+            continue
+        class_id = _MODIFIER_CLASS_BASE + i
+        _modifier_class_members[class_id] = scan_codes
+        _modifier_class_ids[frozenset(scan_codes)] = class_id
+        for scan_code in scan_codes:
+            _modifier_classes[scan_code] = class_id
+
+def _scan_code_bit(scan_code):
+    """
+    Returns the bit for a scan code in a bitset of pressed keys. Negative
+    scan codes (virtual keys on Windows) are interleaved with the positive
+    ones.
+    """
+    return 1 << (scan_code * 2 if scan_code >= 0 else -scan_code * 2 - 1)
+
+class _PressedEvents(dict):
+    """
+    Dict of scan code -> event of the keys currently pressed, that keeps
+    `key`, the sorted tuple of its scan codes, updated as keys are added and
+    removed instead of sorting on every event.
+
+    `lookup_keys` holds the keys under which matching hotkeys are
+    registered: `key` itself and, if a classed modifier is pressed, the same
+    key with those scan codes replaced by their classes.
+
+    `mask` is the same set as a bitset, see `_scan_code_bit`, and `version`
+    is incremented on every change. `waiters` counts the threads waiting for
+    a change in `wait_for_state_change`.
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.classes = {}
+        self.version = 0
+        self.waiters = 0
+        self._reset_keys()
+        self.update(*args, **kwargs)
+
+    def _reset_keys(self):
+        self.key = ()
+        self.class_key = ()
+        self.classed_count = 0
+        self.lookup_keys = ((),)
+        self.mask = 0
+
+    def set_classes(self, classes):
+        self.classes = classes
+        self._reset_keys()
+        for scan_code in list(self):
+            self._add_key(scan_code)
+
+    def _add_key(self, scan_code):
+        key = self.key
+        i = _bisect.bisect(key, scan_code)
+        self.key = key = key[:i] + (scan_code,) + key[i:]
+        self.mask |= _scan_code_bit(scan_code)
+        self.version += 1
+        class_id = self.classes.get(scan_code)
+        if class_id is not None:
+            self.classed_count += 1
+        if self.classed_count:
+            class_key = self.class_key
+            class_or_scan_code = scan_code if class_id is None else class_id
+            i = _bisect.bisect(class_key, class_or_scan_code)
+            self.class_key = class_key[:i] + (class_or_scan_code,) + class_key[i:]
+            self.lookup_keys = (key, self.class_key)
+        else:
+            self.class_key = key
+            self.lookup_keys = (key,)
+
+    def _remove_key(self, scan_code):
+        key = self.key
+        i = _bisect.bisect_left(key, scan_code)
+        self.key = key = key[:i] + key[i+1:]
+        self.mask &= ~_scan_code_bit(scan_code)
+        self.version += 1
+        class_id = self.classes.get(scan_code)
+        if class_id is not None:
+            self.classed_count -= 1
+        if self.classed_count:
+            class_key = self.class_key
+            i = _bisect.bisect_left(class_key, scan_code if class_id is None else class_id)
+            self.class_key = class_key[:i] + class_key[i+1:]
+            self.lookup_keys = (key, self.class_key)
+        else:
+            self.class_key = key
+            self.lookup_keys = (key,)
+
+    def __setitem__(self, scan_code, event):
+        if scan_code not in self:
+            self._add_key(scan_code)
+        dict.__setitem__(self, scan_code, event)
+
+    def __delitem__(self, scan_code):
+        dict.__delitem__(self, scan_code)
+        self._remove_key(scan_code)
+
+    def pop(self, scan_code, *default):
+        if scan_code in self:
+            event = dict.__getitem__(self, scan_code)
+            del self[scan_code]
+            return event
+        return dict.pop(self, scan_code, *default)
+
+    def popitem(self):
+        scan_code, event = dict.popitem(self)
+        self._remove_key(scan_code)
+        return scan_code, event
+
+    def setdefault(self, scan_code, event=None):
+        if scan_code not in self:
+            self[scan_code] = event
+        return dict.__getitem__(self, scan_code)
+
+    def update(self, *args, **kwargs):
+        for scan_code, event in dict(*args, **kwargs).items():
+            self[scan_code] = event
+
+    def clear(self):
+        if self:
+            self.version += 1
+        dict.clear(self)
+        self._reset_keys()
+
+# Also a condition, notified when the pressed keys change.
+_pressed_events_lock = _Condition(_Lock())
+_pressed_events = _PressedEvents()
 _physically_pressed_keys = _pressed_events
 _logically_pressed_keys = {}
+
+class _DispatchTable(dict):
+    """
+    Mapping of key -> tuple of callbacks. Looking up a missing key returns an
+    empty tuple, without inserting it like a defaultdict would.
+    """
+    def __missing__(self, key):
+        return ()
+
+# Snapshot of all registered hooks and hotkeys. Never modified after being
+# published, so the OS hook thread can read it without locks while other
+# threads register callbacks.
+_DispatchTables = _collections.namedtuple('_DispatchTables', [
+    'blocking_hooks',
+    'blocking_keys',
+    'nonblocking_keys',
+    'blocking_hotkeys',
+    'nonblocking_hotkeys',
+    'filtered_modifiers',
+    # Compiled multi-step hotkeys, see `_compile_trie`.
+    'blocking_trie',
+    'nonblocking_trie',
+    # Blocking callbacks that were too slow, run as non-blocking instead.
+    'demoted',
+])
+
+class _DispatchTransaction(object):
+    """
+    Changes to be applied to a `_DispatchTables` snapshot. Each table is
+    copied the first time it's changed, and unchanged tables are shared with
+    the previous snapshot.
+    """
+    def __init__(self, tables):
+        self.tables = tables
+        self.drafts = {}
+        # Multi-step hotkeys to compile, by trie name.
+        self.sequences = {}
+        self.committed = []
+        # Callbacks no longer registered, to drop from the handler stats.
+        self.removed = []
+
+    def _draft(self, name):
+        if name not in self.drafts:
+            table = getattr(self.tables, name)
+            self.drafts[name] = list(table) if isinstance(table, tuple) else type(table)(table)
+        return self.drafts[name]
+
+    def add(self, name, key, callback):
+        table = self._draft(name)
+        table[key] = table[key] + (callback,)
+
+    def remove(self, name, key, callback):
+        table = self._draft(name)
+        callbacks = list(table[key])
+        callbacks.remove(callback)
+        self.removed.append(callback)
+        if callbacks:
+            table[key] = tuple(callbacks)
+        else:
+            del table[key]
+
+    def add_hook(self, callback):
+        self._draft('blocking_hooks').append(callback)
+
+    def remove_hook(self, callback):
+        self._draft('blocking_hooks').remove(callback)
+        self.removed.append(callback)
+
+    def demote(self, callback):
+        tables = self.tables
+        registered = [tables.blocking_hooks] + list(tables.blocking_keys.values()) + list(tables.blocking_hotkeys.values())
+        if not any(callback in callbacks for callbacks in registered):
+            # Removed since it went over budget.
+            return
+        demoted = self._draft('demoted')
+        if callback not in demoted:
+            demoted.append(callback)
+
+    def count_modifier(self, scan_code, delta):
+        counter = self._draft('filtered_modifiers')
+        counter[scan_code] += delta
+        if not counter[scan_code]:
+            del counter[scan_code]
+
+    def _sequences(self, owner):
+        if owner.name not in self.sequences:
+            self.sequences[owner.name] = (owner, list(getattr(self.tables, owner.name).all_sequences))
+        return self.sequences[owner.name][1]
+
+    def add_sequence(self, owner, sequence):
+        """ Adds a multi-step hotkey to the trie of a `_HotkeySequences`. """
+        self._sequences(owner).append(sequence)
+
+    def remove_sequence(self, owner, sequence):
+        self._sequences(owner).remove(sequence)
+        self.removed.append(sequence.callback)
+
+    def clear_sequences(self, owner):
+        sequences = self._sequences(owner)
+        self.removed.extend(sequence.callback for sequence in sequences)
+        del sequences[:]
+
+    def on_commit(self, function):
+        """
+        Calls `function` after the new tables are published, and not at all
+        if the transaction is discarded.
+        """
+        self.committed.append(function)
+
+    def clear(self, *names):
+        for name in names:
+            table = getattr(self.tables, name)
+            if name != 'demoted':
+                self.removed.extend(_itertools.chain(*table.values()) if isinstance(table, dict) else table)
+            self.drafts[name] = [] if isinstance(table, tuple) else type(table)()
+
+    def commit(self):
+        if self.removed and self.tables.demoted and 'demoted' not in self.drafts:
+            self.drafts['demoted'] = [callback for callback in self.tables.demoted if callback not in self.removed]
+        changes = dict(
+            (name, tuple(table) if isinstance(table, list) else table)
+            for name, table in self.drafts.items()
+        )
+        for name, (owner, sequences) in self.sequences.items():
+            changes[name] = _compile_trie(sequences, owner.on_step)
+        return self.tables._replace(**changes)
+
+
+class _BlockingWatchdog(object):
+    """
+    Latency budget for the blocking callbacks of each event, see
+    `set_blocking_budget`.
+    """
+    def __init__(self, budget, demote_after):
+        self.budget = budget
+        self.demote_after = demote_after
+        self.lock = _Lock()
+        self.events_over_budget = 0
+        self.overruns = {} # callback -> count
+        self.to_demote = []
+
+    def start(self, stats, demoted):
+        return _Deadline(self, stats, demoted)
+
+    def overrun(self, callback):
+        with self.lock:
+            self.events_over_budget += 1
+            count = self.overruns[callback] = self.overruns.get(callback, 0) + 1
+            if count == self.demote_after:
+                # Called from the OS hook, which can't wait for the tables
+                # lock. The processing thread demotes it instead.
+                self.to_demote.append(callback)
+
+    def apply_demotions(self):
+        """ Demotes the callbacks queued by `overrun`. """
+        with self.lock:
+            callbacks, self.to_demote = self.to_demote, []
+        if callbacks:
+            with _listener.change_tables() as tables:
+                for callback in callbacks:
+                    tables.demote(callback)
+
+    def forget(self, callbacks):
+        with self.lock:
+            for callback in callbacks:
+                self.overruns.pop(callback, None)
+
+    def stats(self):
+        with self.lock:
+            overruns = list(self.overruns.items())
+            events_over_budget = self.events_over_budget
+        return {
+            'budget': self.budget,
+            'events_over_budget': events_over_budget,
+            'overruns': dict((_describe(callback), count) for callback, count in overruns),
+            'demoted': [_describe(callback) for callback in _listener.tables.demoted],
+        }
+
+class _Deadline(object):
+    """
+    Calls the blocking callbacks of a single event until its budget runs
+    out. Running callbacks can't be interrupted, so the one that crosses the
+    deadline and all later ones are taken as accepting the event. The overrun
+    is blamed on the slowest callback so far, which isn't necessarily the one
+    that crossed the deadline.
+    """
+    def __init__(self, watchdog, stats, demoted):
+        self.watchdog = watchdog
+        self.stats = stats
+        self.demoted = demoted
+        self.end = _timer() + watchdog.budget
+        self.expired = False
+        self.slowest = None
+        self.slowest_duration = -1
+
+    def __call__(self, callback, event):
+        if self.expired or callback in self.demoted:
+            return True
+        start = _timer()
+        result = self.stats.call(callback, event) if self.stats else callback(event)
+        end = _timer()
+        if end - start > self.slowest_duration:
+            self.slowest, self.slowest_duration = callback, end - start
+        if end > self.end:
+            self.expired = True
+            self.watchdog.overrun(self.slowest)
+            return True
+        return result
+
 class _KeyboardListener(_GenericListener):
     transition_table = {
         #Current state of the modifier, per `modifier_states`.
@@ -193,31 +548,133 @@ class _KeyboardListener(_GenericListener):
     }
 
     def init(self):
-        _os_keyboard.init()
+        # Backends that can read the keyboard state return the keys already
+        # held down, so they are known before their first event.
+        pressed_events = _os_keyboard.init() or ()
 
         self.active_modifiers = set()
-        self.blocking_hooks = []
-        self.blocking_keys = _collections.defaultdict(list)
-        self.nonblocking_keys = _collections.defaultdict(list)
-        self.blocking_hotkeys = _collections.defaultdict(list)
-        self.nonblocking_hotkeys = _collections.defaultdict(list)
-        self.filtered_modifiers = _collections.Counter()
+        self.blocking_sequences = _HotkeySequences(suppress=True)
+        self.nonblocking_sequences = _HotkeySequences(suppress=False)
+        self.tables = _DispatchTables(
+            blocking_hooks=(),
+            blocking_keys=_DispatchTable(),
+            nonblocking_keys=_DispatchTable(),
+            blocking_hotkeys=_DispatchTable(),
+            nonblocking_hotkeys=_DispatchTable(),
+            filtered_modifiers=_collections.Counter(),
+            blocking_trie=self.blocking_sequences.root,
+            nonblocking_trie=self.nonblocking_sequences.root,
+            demoted=(),
+        )
+        self.tables_lock = _RLock()
+        self.watchdog = None
+        self.transaction = None
         self.is_replaying = False
 
         # Supporting hotkey suppression is harder than it looks. See
         # https://github.com/boppreh/keyboard/issues/22
         self.modifier_states = {} # "alt" -> "allowed"
 
-    def pre_process_event(self, event):
-        for key_hook in self.nonblocking_keys[event.scan_code]:
-            key_hook(event)
-
         with _pressed_events_lock:
-            hotkey = tuple(sorted(_pressed_events))
-        for callback in self.nonblocking_hotkeys[hotkey]:
-            callback(event)
-
-        return event.scan_code or (event.name and event.name != 'unknown')
+            _update_modifier_classes()
+            _pressed_events.set_classes(_modifier_classes)
+            for event in pressed_events:
+                if is_modifier(event.scan_code): self.active_modifiers.add(event.scan_code)
+                _pressed_events[event.scan_code] = event
+                _logically_pressed_keys[event.scan_code] = event
+            _pressed_events_lock.notify_all()
+
+    # Read-only views of the current snapshot. The hotkeys and modifiers
+    # include the next steps of multi-step hotkeys in progress.
+    blocking_hooks = property(lambda self: self.tables.blocking_hooks)
+    blocking_keys = property(lambda self: self.tables.blocking_keys)
+    nonblocking_keys = property(lambda self: self.tables.nonblocking_keys)
+    blocking_hotkeys = property(lambda self: self._with_steps(self.tables.blocking_hotkeys, self.blocking_sequences))
+    nonblocking_hotkeys = property(lambda self: self._with_steps(self.tables.nonblocking_hotkeys, self.nonblocking_sequences))
+
+    def _with_steps(self, hotkeys, sequences):
+        merged = _DispatchTable(hotkeys)
+        for key, handlers in sequences.locate(getattr(self.tables, sequences.name)).steps.items():
+            merged[key] = merged[key] + handlers
+        return merged
+
+    @property
+    def filtered_modifiers(self):
+        tables = self.tables
+        return (
+            tables.filtered_modifiers
+            + self.blocking_sequences.locate(tables.blocking_trie).step_modifiers
+            + self.nonblocking_sequences.locate(tables.nonblocking_trie).step_modifiers
+        )
+
+    @_contextmanager
+    def change_tables(self):
+        """
+        Yields a `_DispatchTransaction` to register or remove callbacks. The
+        new tables are published at once when the outermost block exits, and
+        discarded if it raises.
+        """
+        with self.tables_lock:
+            if self.transaction is not None:
+                yield self.transaction
+                return
+            self.transaction = _DispatchTransaction(self.tables)
+            transaction = self.transaction
+            try:
+                yield transaction
+                self.tables = transaction.commit()
+            finally:
+                self.transaction = None
+            self.forget_handlers(transaction.removed)
+            for function in transaction.committed:
+                function()
+
+    def forget_handlers(self, handlers):
+        _GenericListener.forget_handlers(self, handlers)
+        watchdog = self.watchdog
+        if watchdog:
+            watchdog.forget(handlers)
+
+    def repeat_key(self, item):
+        # Key presses following another press of the same key are repeats.
+        event = item[0]
+        return event.scan_code, event.event_type == KEY_DOWN
+
+    def pre_process_event(self, item):
+        # Hotkeys are matched against the keys pressed when the event
+        # happened, not when it's processed, and demoted callbacks are the
+        # ones skipped for it then.
+        event, hotkeys, demoted = item
+        watchdog = self.watchdog
+        if watchdog and watchdog.to_demote:
+            watchdog.apply_demotions()
+        stats = self.handler_stats
+        tables = self.tables
+        sequences = self.nonblocking_sequences
+        sequences.check(event, tables.nonblocking_trie)
+        for key_hook in tables.nonblocking_keys.get(event.scan_code, ()):
+            stats.call(key_hook, event) if stats else key_hook(event)
+
+        steps = sequences.node.steps
+        for hotkey in hotkeys:
+            for callback in tables.nonblocking_hotkeys.get(hotkey, ()):
+                stats.call(callback, event) if stats else callback(event)
+        # Steps are part of the dispatch, they time the hotkey callbacks.
+        for hotkey in hotkeys:
+            for step in steps.get(hotkey, ()):
+                step(event)
+
+        if demoted:
+            # Blocking callbacks that went over budget too often run here.
+            blocking = tables.blocking_hooks + tables.blocking_keys.get(event.scan_code, ())
+            for hotkey in hotkeys:
+                blocking += tables.blocking_hotkeys.get(hotkey, ())
+            for callback in blocking:
+                if callback in demoted:
+                    stats.call(callback, event) if stats else callback(event)
+
+        if event.scan_code or (event.name and event.name != 'unknown'):
+            return event
 
     def direct_callback(self, event):
         """
@@ -233,9 +690,23 @@ class _KeyboardListener(_GenericListener):
         if self.is_replaying:
             return True
 
-        if not all(hook(event) for hook in self.blocking_hooks):
+        # Each stage reads the latest snapshot of the dispatch tables, so
+        # callbacks can affect later stages (e.g. multi-step hotkeys resetting
+        # their state) but never see a partial registration.
+        stats = self.handler_stats
+        watchdog = self.watchdog
+        demoted = self.tables.demoted
+        if watchdog:
+            call = watchdog.start(stats, demoted)
+        else:
+            call = stats.call if stats else None
+
+        if not all((call(hook, event) if call else hook(event)) for hook in self.tables.blocking_hooks):
             return False
 
+        sequences = self.blocking_sequences
+        sequences.check(event, self.tables.blocking_trie)
+
         event_type = event.event_type
         scan_code = event.scan_code
 
@@ -244,41 +715,71 @@ class _KeyboardListener(_GenericListener):
             if event_type == KEY_DOWN:
                 if is_modifier(scan_code): self.active_modifiers.add(scan_code)
                 _pressed_events[scan_code] = event
-            hotkey = tuple(sorted(_pressed_events))
+            hotkeys = _pressed_events.lookup_keys
             if event_type == KEY_UP:
                 self.active_modifiers.discard(scan_code)
                 if scan_code in _pressed_events: del _pressed_events[scan_code]
+            if _pressed_events.waiters:
+                _pressed_events_lock.notify_all()
 
         # Mappings based on individual keys instead of hotkeys.
-        for key_hook in self.blocking_keys[scan_code]:
-            if not key_hook(event):
+        for key_hook in self.tables.blocking_keys.get(scan_code, ()):
+            if not (call(key_hook, event) if call else key_hook(event)):
                 return False
 
         # Default accept.
         accept = True
 
-        if self.blocking_hotkeys:
-            if self.filtered_modifiers[scan_code]:
+        tables = self.tables
+        sequences.sync(tables.blocking_trie)
+        steps = sequences.node.steps
+        if tables.blocking_hotkeys or steps:
+            if (
+                    tables.filtered_modifiers.get(scan_code)
+                    or sequences.node.step_modifiers.get(scan_code)
+                    or self.nonblocking_sequences.node.step_modifiers.get(scan_code)
+                ):
                 origin = 'modifier'
                 modifiers_to_update = set([scan_code])
             else:
                 modifiers_to_update = self.active_modifiers
                 if is_modifier(scan_code):
                     modifiers_to_update = modifiers_to_update | {scan_code}
-                callback_results = [callback(event) for callback in self.blocking_hotkeys[hotkey]]
-                if callback_results:
+                callback_results = [
+                    call(callback, event) if call else callback(event)
+                    for hotkey in hotkeys
+                    for callback in tables.blocking_hotkeys.get(hotkey, ())
+                ]
+                if not (watchdog and call.expired):
+                    callback_results += [
+                        step(event)
+                        for hotkey in hotkeys
+                        for step in steps.get(hotkey, ())
+                    ]
+                if watchdog and call.expired:
+                    # Failing open below, so act as if no hotkey matched.
+                    origin = 'other'
+                elif callback_results:
                     accept = all(callback_results)
                     origin = 'hotkey'
                 else:
                     origin = 'other'
 
             for key in sorted(modifiers_to_update):
-                transition_tuple = (self.modifier_states.get(key, 'free'), event_type, origin)
-                should_press, new_accept, new_state = self.transition_table[transition_tuple]
+                if watchdog and call.expired and origin == 'modifier':
+                    # The modifier goes through with the event.
+                    should_press, new_accept, new_state = False, True, 'allowed' if event_type == KEY_DOWN else 'free'
+                else:
+                    transition_tuple = (self.modifier_states.get(key, 'free'), event_type, origin)
+                    should_press, new_accept, new_state = self.transition_table[transition_tuple]
                 if should_press: press(key)
                 if new_accept is not None: accept = new_accept
                 self.modifier_states[key] = new_state
 
+        if watchdog and call.expired:
+            # Fail open, the user is already waiting for this event.
+            accept = True
+
         if accept:
             if event_type == KEY_DOWN:
                 _logically_pressed_keys[scan_code] = event
@@ -286,7 +787,7 @@ class _KeyboardListener(_GenericListener):
                 del _logically_pressed_keys[scan_code]
 
         # Queue for handlers that won't block the event.
-        self.queue.put(event)
+        self.queue.put((event, hotkeys, demoted))
 
         return accept
 
@@ -325,6 +826,56 @@ def key_to_scan_codes(key, error_if_missing=True):
     else:
         return t
 
+_CacheInfo = _collections.namedtuple('_CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class _ParseCache(object):
+    """
+    Bounded, thread-safe LRU cache of parsed hotkey strings. Emptied whenever
+    the backend rebuilds its keymap, since scan codes may have changed.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = _Lock()
+        self.entries = _collections.OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, hotkey, parse):
+        generation = getattr(_os_keyboard, 'keymap_generation', None)
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+            # Popped and inserted again to mark it as most recently used.
+            parsed = self.entries.pop(hotkey, None)
+            if parsed is not None:
+                self.entries[hotkey] = parsed
+                self.hits += 1
+                return parsed
+            self.misses += 1
+
+        # Parsed outside the lock, as it may build the keymap tables.
+        parsed = parse(hotkey)
+        with self.lock:
+            if generation == self.generation:
+                self.entries[hotkey] = parsed
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return parsed
+
+    def info(self):
+        with self.lock:
+            return _CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+_parse_cache = _ParseCache(maxsize=512)
+
 def parse_hotkey(hotkey):
     """
     Parses a user-provided hotkey into nested tuples representing the
@@ -339,7 +890,16 @@ def parse_hotkey(hotkey):
         #    Steps:   ^~~~~~~~~~^  ^~~~^  ^
 
         # ((alt_codes, shift_codes, a_codes), (alt_codes, b_codes), (c_codes,))
+
+    Parsed strings are cached, see `parse_hotkey.cache_info()`.
     """
+    if _is_str(hotkey):
+        return _parse_cache.get(hotkey, _parse_hotkey)
+    return _parse_hotkey(hotkey)
+parse_hotkey.cache_info = _parse_cache.info
+parse_hotkey.cache_clear = _parse_cache.clear
+
+def _parse_hotkey(hotkey):
     if _is_number(hotkey) or len(hotkey) == 1:
         scan_codes = key_to_scan_codes(hotkey)
         step = (scan_codes,)
@@ -414,17 +974,116 @@ def is_pressed(hotkey):
         with _pressed_events_lock:
             return hotkey in _pressed_events
 
-    steps = parse_hotkey(hotkey)
-    if len(steps) > 1:
-        raise ValueError("Impossible to check if multi-step hotkeys are pressed (`a+b` is ok, `a, b` isn't).")
+    return _PressedCheck(hotkey)()
 
-    # Convert _pressed_events into a set 
-    with _pressed_events_lock:
-        pressed_scan_codes = set(_pressed_events)
-    for scan_codes in steps[0]:
-        if not any(scan_code in pressed_scan_codes for scan_code in scan_codes):
+class _PressedCheck(object):
+    """
+    Checks if a single-step hotkey is pressed. See `compile_pressed_check`.
+    """
+    def __init__(self, hotkey):
+        steps = parse_hotkey(hotkey)
+        if len(steps) > 1:
+            raise ValueError("Impossible to check if multi-step hotkeys are pressed (`a+b` is ok, `a, b` isn't).")
+        self.hotkey = hotkey
+        # Keys with a single scan code must all be in the bitset, and keys
+        # with many need at least one of them.
+        self.required = 0
+        self.alternatives = []
+        for scan_codes in steps[0]:
+            bits = 0
+            for scan_code in scan_codes:
+                bits |= _scan_code_bit(scan_code)
+            if len(scan_codes) == 1:
+                self.required |= bits
+            else:
+                self.alternatives.append(bits)
+
+    def test(self, mask):
+        """ Returns True if the hotkey is pressed in the given bitset. """
+        required = self.required
+        if mask & required != required:
             return False
-    return True
+        for bits in self.alternatives:
+            if not mask & bits:
+                return False
+        return True
+
+    def __call__(self):
+        return self.test(_pressed_events.mask)
+
+    def __repr__(self):
+        return 'compile_pressed_check({!r})'.format(self.hotkey)
+
+def compile_pressed_check(hotkey):
+    """
+    Returns a function that returns True if the hotkey is pressed, like
+    `is_pressed(hotkey)`. The hotkey is parsed only once, and each call is a
+    couple of bitwise operations on the current state, with no locks, so
+    it's suited for loops that poll the keyboard many times per second.
+
+    Scan codes are resolved when compiled, so compile again if the keyboard
+    layout changes.
+
+        is_moving_forward = compile_pressed_check('shift+w')
+        while is_moving_forward(): ...
+    """
+    _listener.start_if_necessary()
+    return _PressedCheck(hotkey)
+
+def are_pressed(hotkeys):
+    """
+    Returns a list with `is_pressed(hotkey)` for each hotkey, all checked
+    against the same state. Hotkeys can also be the checks returned by
+    `compile_pressed_check`, which avoids compiling them again.
+
+        shift, w, a = are_pressed(['shift', 'w', 'a'])
+    """
+    _listener.start_if_necessary()
+    checks = [hotkey if isinstance(hotkey, _PressedCheck) else _PressedCheck(hotkey) for hotkey in hotkeys]
+    mask = _pressed_events.mask
+    return [check.test(mask) for check in checks]
+
+_PressedState = _collections.namedtuple('PressedState', ['version', 'scan_codes'])
+
+def snapshot():
+    """
+    Returns `(version, scan_codes)`, where `scan_codes` is a frozenset of the
+    keys currently pressed and `version` increases every time a key is
+    pressed or released. Pass the version to `wait_for_state_change` to wait
+    for the next change without polling.
+    """
+    _listener.start_if_necessary()
+    with _pressed_events_lock:
+        return _PressedState(_pressed_events.version, frozenset(_pressed_events))
+
+def wait_for_state_change(since_version=None, timeout=None):
+    """
+    Blocks until the pressed keys change from the given `snapshot` version
+    (or from the current state, if not given), and returns the new
+    `snapshot()`. Returns None if `timeout` seconds pass first.
+
+        state = snapshot()
+        while True:
+            state = wait_for_state_change(state.version)
+            print(state.scan_codes)
+    """
+    _listener.start_if_necessary()
+    deadline = None if timeout is None else _time.monotonic() + timeout
+    with _pressed_events_lock:
+        if since_version is None:
+            since_version = _pressed_events.version
+        _pressed_events.waiters += 1
+        try:
+            while _pressed_events.version == since_version:
+                # Waits in small intervals, so it can be interrupted with
+                # Ctrl+C (see `_Event`).
+                remaining = 0.5 if deadline is None else min(0.5, deadline - _time.monotonic())
+                if remaining <= 0:
+                    return None
+                _pressed_events_lock.wait(remaining)
+        finally:
+            _pressed_events.waiters -= 1
+        return _PressedState(_pressed_events.version, frozenset(_pressed_events))
 
 def call_later(fn, args=(), delay=0.001):
     """
@@ -435,8 +1094,20 @@ def call_later(fn, args=(), delay=0.001):
     thread = _Thread(target=lambda: (_time.sleep(delay), fn(*args)))
     thread.start()
 
+def _offload(callback, executor, suppress):
+    """
+    Returns a handler that runs `callback` on `executor`, if given.
+    Suppressing hooks decide whether to block each event as it happens, so
+    they can't be offloaded.
+    """
+    if executor is None:
+        return callback
+    if suppress:
+        raise ValueError('Hooks with suppress=True must run synchronously and do not accept an executor.')
+    return executor.wrap(callback)
+
 _hooks = {}
-def hook(callback, suppress=False, on_remove=lambda: None):
+def hook(callback, suppress=False, on_remove=lambda: None, executor=None, batch=False):
     """
     Installs a global listener on all available keyboards, invoking `callback`
     each time a key is pressed or released.
@@ -450,70 +1121,101 @@ def hook(callback, suppress=False, on_remove=lambda: None):
     - `time`: timestamp of the time the event occurred, with as much precision
     as given by the OS.
 
+    If a `CallbackExecutor` is given, the callback runs on its threads
+    instead of delaying the processing of other events.
+
+    With `batch`, the callback receives a list of events instead, with all
+    the events that arrived while the previous list was processed. Useful
+    for callbacks with a cost per call, like writing to a file.
+
     Returns the given callback for easier development.
     """
+    if suppress and batch:
+        raise ValueError('Hooks with suppress=True receive one event at a time and do not accept batch=True.')
+    handler = _offload(callback, executor, suppress)
     if suppress:
         _listener.start_if_necessary()
-        append, remove = _listener.blocking_hooks.append, _listener.blocking_hooks.remove
+        def append(callback):
+            with _listener.change_tables() as tables:
+                tables.add_hook(callback)
+        def remove(callback):
+            with _listener.change_tables() as tables:
+                tables.remove_hook(callback)
     else:
-        append, remove = _listener.add_handler, _listener.remove_handler
+        append = lambda handler: _listener.add_handler(handler, batch=batch)
+        remove = _listener.remove_handler
 
-    append(callback)
+    append(handler)
     def remove_():
         del _hooks[callback]
         del _hooks[remove_]
-        remove(callback)
+        remove(handler)
         on_remove()
     _hooks[callback] = _hooks[remove_] = remove_
     return remove_
 
-def on_press(callback, suppress=False):
+def on_press(callback, suppress=False, executor=None):
     """
     Invokes `callback` for every KEY_DOWN event. For details see `hook`.
     """
-    return hook(lambda e: e.event_type == KEY_UP or callback(e), suppress=suppress)
+    callback = _offload(callback, executor, suppress)
+    handler = lambda e: e.event_type == KEY_UP or callback(e)
+    handler.__wrapped__ = callback
+    return hook(handler, suppress=suppress)
 
-def on_release(callback, suppress=False):
+def on_release(callback, suppress=False, executor=None):
     """
     Invokes `callback` for every KEY_UP event. For details see `hook`.
     """
-    return hook(lambda e: e.event_type == KEY_DOWN or callback(e), suppress=suppress)
+    callback = _offload(callback, executor, suppress)
+    handler = lambda e: e.event_type == KEY_DOWN or callback(e)
+    handler.__wrapped__ = callback
+    return hook(handler, suppress=suppress)
 
-def hook_key(key, callback, suppress=False):
+def hook_key(key, callback, suppress=False, executor=None):
     """
     Hooks key up and key down events for a single key. Returns the event handler
     created. To remove a hooked key use `unhook_key(key)` or
-    `unhook_key(handler)`.
+    `unhook_key(handler)`. See `hook` for `executor`.
 
     Note: this function shares state with hotkeys, so `clear_all_hotkeys`
     affects it as well.
     """
+    handler = _offload(callback, executor, suppress)
     _listener.start_if_necessary()
-    store = _listener.blocking_keys if suppress else _listener.nonblocking_keys
+    store = 'blocking_keys' if suppress else 'nonblocking_keys'
     scan_codes = key_to_scan_codes(key)
-    for scan_code in scan_codes:
-        store[scan_code].append(callback)
+    with _listener.change_tables() as tables:
+        for scan_code in scan_codes:
+            tables.add(store, scan_code, handler)
 
     def remove_():
         del _hooks[callback]
         del _hooks[key]
         del _hooks[remove_]
-        for scan_code in scan_codes:
-            store[scan_code].remove(callback)
+        with _listener.change_tables() as tables:
+            for scan_code in scan_codes:
+                tables.remove(store, scan_code, handler)
     _hooks[callback] = _hooks[key] = _hooks[remove_] = remove_
     return remove_
 
-def on_press_key(key, callback, suppress=False):
+def on_press_key(key, callback, suppress=False, executor=None):
     """
     Invokes `callback` for KEY_DOWN event related to the given key. For details see `hook`.
     """
-    return hook_key(key, lambda e: e.event_type == KEY_UP or callback(e), suppress=suppress)
+    callback = _offload(callback, executor, suppress)
+    handler = lambda e: e.event_type == KEY_UP or callback(e)
+    handler.__wrapped__ = callback
+    return hook_key(key, handler, suppress=suppress)
 
-def on_release_key(key, callback, suppress=False):
+def on_release_key(key, callback, suppress=False, executor=None):
     """
     Invokes `callback` for KEY_UP event related to the given key. For details see `hook`.
     """
-    return hook_key(key, lambda e: e.event_type == KEY_DOWN or callback(e), suppress=suppress)
+    callback = _offload(callback, executor, suppress)
+    handler = lambda e: e.event_type == KEY_DOWN or callback(e)
+    handler.__wrapped__ = callback
+    return hook_key(key, handler, suppress=suppress)
 
 def unhook(remove):
     """
@@ -529,12 +1231,115 @@ def unhook_all():
     listeners, `record`ers and `wait`s.
     """
     _listener.start_if_necessary()
-    _listener.blocking_keys.clear()
-    _listener.nonblocking_keys.clear()
-    del _listener.blocking_hooks[:]
-    del _listener.handlers[:]
+    with _listener.change_tables() as tables:
+        tables.clear('blocking_keys', 'nonblocking_keys', 'blocking_hooks', 'demoted')
+        _listener.remove_all_handlers()
     unhook_all_hotkeys()
 
+def configure_queue(maxsize=0, policy='block'):
+    """
+    Limits the events waiting for non-suppressing hooks and hotkeys to
+    `maxsize` (0 for no limit), so a stalled handler can't use unbounded
+    memory. `policy` is what happens to new events when the limit is
+    reached:
+
+    - 'block': waits for room, delaying all keyboard input.
+    - 'drop_oldest': discards the oldest waiting event.
+    - 'drop_newest': discards the new event.
+    - 'coalesce': a repeated press of a held key replaces the waiting press
+    of that key, otherwise goes over the limit so no press or release is lost.
+
+    Suppressing hooks and hotkeys, and the state used by `is_pressed`, are
+    not affected. See `queue_stats` for the number of dropped events.
+    """
+    _listener.queue.configure(maxsize, policy)
+
+def queue_stats():
+    """
+    Returns a dict with the current `size`, `maxsize` and `policy` of the
+    queue of events waiting for non-suppressing handlers, the number of
+    events `dropped` and the largest size reached, `high_water`.
+    """
+    return _listener.queue.stats()
+
+def os_drop_count():
+    """
+    Returns how many times the OS dropped keyboard events because the
+    listener fell behind, like when the event buffer of a Linux input device
+    overflows. Pressed keys are read again from the device after each drop,
+    so `is_pressed` recovers, but hooks miss the lost events.
+
+    Returns None on platforms that don't report drops.
+    """
+    get_drop_count = getattr(_os_keyboard, 'get_drop_count', None)
+    return get_drop_count() if get_drop_count else None
+
+def enable_stats(slow_threshold=None, on_slow=None):
+    """
+    Starts timing every hook and hotkey callback, suppressing or not, to
+    find the ones that delay keyboard input. Timings are reset, and can be
+    read with `stats`.
+
+    If `slow_threshold` (in seconds) is given, `on_slow(name, duration)` is
+    called every time a callback takes longer than that. It's called on the
+    thread that ran the callback, possibly the OS hook, so it should return
+    quickly.
+
+        enable_stats(0.005, lambda name, duration: print(name, duration))
+    """
+    _listener.handler_stats = _HandlerStats(slow_threshold, on_slow)
+
+def disable_stats():
+    """ Stops timing callbacks. See `enable_stats`. """
+    _listener.handler_stats = None
+
+def stats():
+    """
+    Returns a dict with:
+
+    - `handlers`: a list with a dict for each callback called since
+    `enable_stats` and still hooked, slowest first, with its `name`, number
+    of `calls`, `total` and `max` time in seconds, and a `histogram` as a
+    list of (upper bound in seconds, number of calls).
+    - `queue`: the `queue_stats` of the events waiting for non-suppressing
+    handlers.
+    - `os_drops`: the `os_drop_count`, events lost before reaching the
+    listener.
+    - `blocking`: if `set_blocking_budget` is in use, the `budget`, the
+    number of `events_over_budget`, the `overruns` of each callback and the
+    callbacks `demoted` to non-blocking.
+    """
+    handler_stats = _listener.handler_stats
+    watchdog = _listener.watchdog
+    return {
+        'handlers': handler_stats.snapshot() if handler_stats else [],
+        'queue': queue_stats(),
+        'os_drops': os_drop_count(),
+        'blocking': watchdog.stats() if watchdog else None,
+    }
+
+def set_blocking_budget(budget, demote_after=None):
+    """
+    Limits how long suppressing hooks and hotkeys may delay each event, in
+    seconds. Once the callbacks of an event go over `budget`, the remaining
+    ones are skipped and the event is let through, as a slow hook otherwise
+    delays every keystroke in the system. A callback can't be interrupted,
+    so the one running when the budget runs out still finishes.
+
+    Each event over budget counts as an overrun of its slowest callback. If
+    `demote_after` is given, a callback with that many overruns stops
+    suppressing, and is called after each event like a non-suppressing hook
+    instead. Pass None as `budget` to disable the limit and restore demoted
+    callbacks. Counters are in `stats()['blocking']`.
+
+        set_blocking_budget(0.010, demote_after=3)
+    """
+    _listener.start_if_necessary()
+    _listener.watchdog = None if budget is None else _BlockingWatchdog(budget, demote_after)
+    if budget is None:
+        with _listener.change_tables() as tables:
+            tables.clear('demoted')
+
 def block_key(key):
     """
     Suppresses all key events of the given key, regardless of modifiers.
@@ -572,31 +1377,274 @@ def parse_hotkey_combinations(hotkey):
 
     return tuple(tuple(combine_step(step)) for step in parse_hotkey(hotkey))
 
-def _add_hotkey_step(handler, combinations, suppress):
+def _hotkey_step_keys(step):
+    """
+    Returns the keys under which a parsed hotkey step is registered. If every
+    key is a whole modifier class (e.g. 'ctrl') or a single unclassed scan
+    code, that's one key matched against the classes of pressed modifiers.
+    Otherwise it's every combination of scan codes, like
+    `parse_hotkey_combinations`.
+    """
+    canonical = []
+    for scan_codes in step:
+        class_id = _modifier_class_ids.get(frozenset(scan_codes))
+        if class_id is not None:
+            canonical.append(class_id)
+        elif len(scan_codes) == 1 and scan_codes[0] not in _modifier_classes:
+            canonical.append(scan_codes[0])
+        else:
+            return tuple(tuple(sorted(scan_codes)) for scan_codes in _itertools.product(*step))
+    return (tuple(sorted(canonical)),)
+
+def _step_modifiers(keys):
     """
-    Hooks a single-step hotkey (e.g. 'shift+a').
+    Returns the modifier scan codes in the given hotkey step keys. They have
+    to be registered in filtered_modifiers too, so suppression and replaying
+    can work.
     """
-    container = _listener.blocking_hotkeys if suppress else _listener.nonblocking_hotkeys
+    return [
+        scan_code
+        for key in keys
+        for class_or_scan_code in key
+        for scan_code in _modifier_class_members.get(class_or_scan_code, (class_or_scan_code,))
+        if is_modifier(scan_code)
+    ]
 
-    # Register the scan codes of every possible combination of
-    # modfiier + main key. Modifiers have to be registered in 
-    # filtered_modifiers too, so suppression and replaying can work.
-    for scan_codes in combinations:
-        for scan_code in scan_codes:
-            if is_modifier(scan_code):
-                _listener.filtered_modifiers[scan_code] += 1
-        container[scan_codes].append(handler)
+def _add_hotkey_step(handler, keys, suppress):
+    """
+    Hooks a single-step hotkey (e.g. 'shift+a'), given the keys from
+    `_hotkey_step_keys`.
+    """
+    container = 'blocking_hotkeys' if suppress else 'nonblocking_hotkeys'
+    modifiers = _step_modifiers(keys)
+    with _listener.change_tables() as tables:
+        for scan_code in modifiers:
+            tables.count_modifier(scan_code, 1)
+        for key in keys:
+            tables.add(container, key, handler)
 
     def remove():
-        for scan_codes in combinations:
-            for scan_code in scan_codes:
-                if is_modifier(scan_code):
-                    _listener.filtered_modifiers[scan_code] -= 1
-            container[scan_codes].remove(handler)
+        with _listener.change_tables() as tables:
+            for scan_code in modifiers:
+                tables.count_modifier(scan_code, -1)
+            for key in keys:
+                tables.remove(container, key, handler)
     return remove
 
+def _add_hotkey_sequence(sequence, suppress):
+    """ Hooks a multi-step hotkey, see `_HotkeySequences`. """
+    sequences = _listener.blocking_sequences if suppress else _listener.nonblocking_sequences
+    with _listener.change_tables() as tables:
+        tables.add_sequence(sequences, sequence)
+
+    def remove():
+        with _listener.change_tables() as tables:
+            tables.remove_sequence(sequences, sequence)
+    return remove
+
+class _HotkeySequence(object):
+    """ A multi-step hotkey, as registered in `_HotkeySequences`. """
+    def __init__(self, steps, scan_codes_by_step, callback, event_type, timeout):
+        self.steps = steps
+        self.scan_codes_by_step = scan_codes_by_step
+        self.callback = callback
+        self.event_type = event_type
+        self.timeout = timeout
+
+class _SequenceNode(object):
+    """
+    Node of a compiled multi-step hotkey trie, reached after pressing the
+    steps in `path`. `passing` are the sequences that continue through its
+    children, and `sequences` the ones that end at it.
+
+    `steps` maps the keys of the next steps to their handlers, like the
+    hotkey dispatch tables, and `step_modifiers` counts their modifiers. Not
+    modified after `_compile_trie` returns.
+    """
+    def __init__(self, parent=None, keys=(), scan_codes=()):
+        self.parent = parent
+        self.path = parent.path + (keys,) if parent else ()
+        self.keys = keys
+        self.scan_codes = scan_codes
+        self.handler = None
+        self.children = {}
+        self.passing = []
+        self.sequences = []
+
+    def summarize(self):
+        """
+        Fills the step tables, the scan codes of the next steps, the event
+        types that fail the sequences if another key is used, and the
+        timeout for the next step (None for no timeout).
+        """
+        self.steps = _DispatchTable()
+        self.step_modifiers = _collections.Counter()
+        for child in self.children.values():
+            for key in child.keys:
+                self.steps[key] = self.steps[key] + (child.handler,)
+            for scan_code in _step_modifiers(child.keys):
+                self.step_modifiers[scan_code] += 1
+        timeouts = [sequence.timeout for sequence in self.passing]
+        self.allowed_scan_codes = set().union(*(child.scan_codes for child in self.children.values()))
+        self.miss_event_types = set(sequence.event_type for sequence in self.passing)
+        self.timeout = None if not timeouts or not all(timeouts) else max(timeouts)
+
+def _compile_trie(sequences, on_step):
+    """
+    Compiles multi-step hotkeys into a trie with shared prefixes, where
+    reaching a node calls `on_step(node, event)`. Returns the root, with all
+    `sequences` in `all_sequences`.
+    """
+    root = _SequenceNode()
+    root.all_sequences = tuple(sequences)
+    nodes = [root]
+    for sequence in sequences:
+        node = root
+        for keys, scan_codes in zip(sequence.steps, sequence.scan_codes_by_step):
+            node.passing.append(sequence)
+            child = node.children.get(keys)
+            if child is None:
+                child = node.children[keys] = _SequenceNode(node, keys, scan_codes)
+                child.handler = lambda event, child=child: on_step(child, event)
+                nodes.append(child)
+            node = child
+        node.sequences.append(sequence)
+    for node in nodes:
+        node.summarize()
+    return root
+
+class _HotkeySequences(object):
+    """
+    Progress through the multi-step hotkeys with the same `suppress`
+    setting. The hotkeys are compiled into a trie (see `_compile_trie`) and
+    published with the dispatch tables, under `name`. Only the steps that can
+    follow the current node are matched, and `check` runs once per event to
+    handle wrong keys and timeouts, replaying suppressed events on failure.
+
+    Only the thread that dispatches these hotkeys moves through the trie (the
+    OS hook for suppressing ones, the processing thread otherwise), so the
+    current position needs no lock.
+    """
+    def __init__(self, suppress):
+        self.suppress = suppress
+        self.name = 'blocking_trie' if suppress else 'nonblocking_trie'
+        self.root = _compile_trie((), self.on_step)
+        self.node = self.root
+        self.held_events = []
+        self.triggered = False
+        self.last_update = float('-inf')
+
+    def locate(self, root):
+        """
+        Returns the node of the trie `root` with the same path as the current
+        node, or `root` if the steps were removed.
+        """
+        if root is self.root:
+            return self.node
+        node = root
+        for keys in self.node.path:
+            node = node.children.get(keys)
+            if node is None:
+                return root
+        return node
+
+    def sync(self, root):
+        """ Follows the trie `root`, after hotkeys were added or removed. """
+        if root is not self.root:
+            node = self.locate(root)
+            self.root = root
+            if node is root:
+                self._reset()
+            self.node = node
+
+    def _reset(self):
+        self.node = self.root
+        self.held_events = []
+        self.triggered = False
+
+    def _move(self, node):
+        """ Makes `node` the current node, so its children's steps are matched. """
+        self.node = node
+        self.last_update = _time.monotonic()
+
+    def _fail(self):
+        """ Goes back to the root, replaying any events held so far. """
+        held_events = self.held_events
+        self._reset()
+        self._move(self.root)
+        if self.suppress:
+            for event in held_events:
+                if event.event_type == KEY_DOWN:
+                    press(event.scan_code)
+                else:
+                    release(event.scan_code)
+
+    def check(self, event, root):
+        """
+        Called for every event before hotkeys are matched, with the latest
+        trie. Fails the current sequence if a key outside the next steps is
+        pressed, or it timed out.
+        """
+        if root is not self.root:
+            self.sync(root)
+        node = self.node
+        if node is root:
+            return
+        if (
+                event.event_type in node.miss_event_types
+                and event.scan_code not in node.allowed_scan_codes
+            ) or (
+                node.timeout
+                and _time.monotonic() - self.last_update >= node.timeout
+            ):
+            self._fail()
+
+    def on_step(self, child, event):
+        """ Hotkey handler for the steps that follow the current node. """
+        if child.parent is not self.node:
+            # Step of a previous node.
+            return True
+
+        if event.event_type == KEY_UP and self.triggered:
+            # Release of the key that completed a sequence.
+            self.triggered = False
+            if child.children:
+                self._move(child)
+            else:
+                self._move(self.root)
+            return False
+
+        now = _time.monotonic()
+        matches = [
+            sequence for sequence in child.sequences
+            if sequence.event_type == event.event_type
+            and (not sequence.timeout or now - self.last_update < sequence.timeout)
+        ]
+        if matches:
+            # The callback may allow the hotkey, in which case the held
+            # events are replayed and this one passes through.
+            stats = _listener.handler_stats
+            results = [stats.call(sequence.callback) if stats else sequence.callback() for sequence in matches]
+            if any(results):
+                self._fail()
+                return True
+            self.held_events = []
+            if event.event_type == KEY_DOWN:
+                self.triggered = True
+            else:
+                self._move(child if child.children else self.root)
+            return False
+
+        self.held_events.append(event)
+        if event.event_type == KEY_UP:
+            if child.children:
+                self._move(child)
+            else:
+                self._fail()
+        return False
+
 _hotkeys = {}
-def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_release=False):
+def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_release=False, executor=None):
     """
     Invokes a callback every time a hotkey is pressed. The hotkey must
     be in the format `ctrl+shift+a, s`. This would trigger when the user holds
@@ -611,6 +1659,9 @@ def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_
     - `timeout` is the amount of seconds allowed to pass between key presses.
     - `trigger_on_release` if true, the callback is invoked on key release instead
     of key press.
+    - `executor` is an optional `CallbackExecutor` to run the callback on, so
+    slow callbacks don't delay other events. Its return value is then
+    ignored, and suppressed hotkeys always block their keys.
 
     The event handler function is returned. To remove a hotkey call
     `remove_hotkey(hotkey)` or `remove_hotkey(handler)`.
@@ -634,11 +1685,19 @@ def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_
         add_hotkey('ctrl+alt+enter, space', some_callback)
     """
     if args:
-        callback = lambda callback=callback: callback(*args)
+        with_args = lambda callback=callback: callback(*args)
+        with_args.__wrapped__ = callback
+        callback = with_args
 
     _listener.start_if_necessary()
+    return _add_parsed_hotkey(hotkey, parse_hotkey(hotkey), callback, suppress, timeout, trigger_on_release, executor)
+register_hotkey = add_hotkey
 
-    steps = parse_hotkey_combinations(hotkey)
+def _add_parsed_hotkey(hotkey, parsed_steps, callback, suppress, timeout, trigger_on_release, executor):
+    """ Registers a hotkey already parsed by `parse_hotkey`. See `add_hotkey`. """
+    steps = [tuple(_hotkey_step_keys(step)) for step in parsed_steps]
+    # Offloaded hotkeys may still suppress, so `suppress` isn't checked.
+    run = _offload(callback, executor, False)
 
     event_type = KEY_UP if trigger_on_release else KEY_DOWN
     if len(steps) == 1:
@@ -646,101 +1705,57 @@ def add_hotkey(hotkey, callback, args=(), suppress=False, timeout=1, trigger_on_
         # and any mistake will make that key "sticky". Therefore just let all
         # KEY_UP events go through as long as that's not what we are listening
         # for.
-        handler = lambda e: (event_type == KEY_DOWN and e.event_type == KEY_UP and e.scan_code in _logically_pressed_keys) or (event_type == e.event_type and callback())
-        remove_step = _add_hotkey_step(handler, steps[0], suppress)
-        def remove_():
-            remove_step()
-            del _hotkeys[hotkey]
-            del _hotkeys[remove_]
-            del _hotkeys[callback]
+        handler = lambda e: (event_type == KEY_DOWN and e.event_type == KEY_UP and e.scan_code in _logically_pressed_keys) or (event_type == e.event_type and run())
+        handler.__wrapped__ = callback
+        register = lambda: _add_hotkey_step(handler, steps[0], suppress)
+    else:
+        sequence = _HotkeySequence(steps, [set(_itertools.chain(*step)) for step in parsed_steps], run, event_type, timeout)
+        register = lambda: _add_hotkey_sequence(sequence, suppress)
+
+    # `_hotkeys` is only changed once the tables are published, so a
+    # failed `add_hotkeys` leaves no trace.
+    def remove_():
+        with _listener.change_tables() as tables:
+            remove_registration()
+            tables.on_commit(forget)
+    def remember():
         # TODO: allow multiple callbacks for each hotkey without overwriting the
         # remover.
         _hotkeys[hotkey] = _hotkeys[remove_] = _hotkeys[callback] = remove_
-        return remove_
-
-    state = _State()
-    state.remove_catch_misses = None
-    state.remove_last_step = None
-    state.suppressed_events = []
-    state.last_update = float('-inf')
-    
-    def catch_misses(event, force_fail=False):
-        if (
-                event.event_type == event_type
-                and state.index
-                and event.scan_code not in allowed_keys_by_step[state.index]
-            ) or (
-                timeout
-                and _time.monotonic() - state.last_update >= timeout
-            ) or force_fail: # Weird formatting to ensure short-circuit.
-
-            state.remove_last_step()
-
-            for event in state.suppressed_events:
-                if event.event_type == KEY_DOWN:
-                    press(event.scan_code)
-                else:
-                    release(event.scan_code)
-            del state.suppressed_events[:]
+    def forget():
+        # Another hotkey may have been registered with the same callback
+        # since, and owns that entry now.
+        for key in (hotkey, remove_, callback):
+            if _hotkeys.get(key) is remove_:
+                del _hotkeys[key]
+    with _listener.change_tables() as tables:
+        remove_registration = register()
+        tables.on_commit(remember)
+    return remove_
 
-            index = 0
-            set_index(0)
-        return True
+def add_hotkeys(hotkeys, suppress=False, timeout=1, trigger_on_release=False, executor=None):
+    """
+    Registers many hotkeys at once, from a dict of `hotkey: callback` (or a
+    list of pairs). Same as calling `add_hotkey` for each one, but all
+    hotkeys are parsed before any is registered, so an invalid hotkey raises
+    `ValueError` without changing anything. The hooks see either none or all
+    of them, and the tables are rebuilt only once.
 
-    def set_index(new_index):
-        state.index = new_index
-
-        if new_index == 0:
-            # This is done for performance reasons, avoiding a global key hook
-            # that is always on.
-            state.remove_catch_misses = lambda: None
-        elif new_index == 1:
-            state.remove_catch_misses()
-            # Must be `suppress=True` to ensure `send` has priority.
-            state.remove_catch_misses = hook(catch_misses, suppress=True)
-
-        if new_index == len(steps) - 1:
-            def handler(event):
-                if event.event_type == KEY_UP:
-                    remove()
-                    set_index(0)
-                accept = event.event_type == event_type and callback() 
-                if accept:
-                    return catch_misses(event, force_fail=True)
-                else:
-                    state.suppressed_events[:] = [event]
-                    return False
-            remove = _add_hotkey_step(handler, steps[state.index], suppress)
-        else:
-            # Fix value of next_index.
-            def handler(event, new_index=state.index+1):
-                if event.event_type == KEY_UP:
-                    remove()
-                    set_index(new_index)
-                state.suppressed_events.append(event)
-                return False
-            remove = _add_hotkey_step(handler, steps[state.index], suppress)
-        state.remove_last_step = remove
-        state.last_update = _time.monotonic()
-        return False
-    set_index(0)
+    Returns a dict of hotkey -> remove function, like the ones returned by
+    `add_hotkey`.
 
-    allowed_keys_by_step = [
-        set().union(*step)
-        for step in steps
-    ]
+        add_hotkeys({'ctrl+1': select_first, 'ctrl+2': select_second})
+    """
+    _listener.start_if_necessary()
+    items = hotkeys.items() if hasattr(hotkeys, 'items') else hotkeys
+    parsed = [(hotkey, parse_hotkey(hotkey), callback) for hotkey, callback in items]
 
-    def remove_():
-        state.remove_catch_misses()
-        state.remove_last_step()
-        del _hotkeys[hotkey]
-        del _hotkeys[remove_]
-        del _hotkeys[callback]
-    # TODO: allow multiple callbacks for each hotkey without overwriting the
-    # remover.
-    _hotkeys[hotkey] = _hotkeys[remove_] = _hotkeys[callback] = remove_
-    return remove_
-register_hotkey = add_hotkey
+    removers = {}
+    with _listener.change_tables():
+        for hotkey, parsed_steps, callback in parsed:
+            removers[hotkey] = _add_parsed_hotkey(hotkey, parsed_steps, callback, suppress, timeout, trigger_on_release, executor)
+    return removers
+register_hotkeys = add_hotkeys
 
 def remove_hotkey(hotkey_or_callback):
     """
@@ -750,6 +1765,20 @@ def remove_hotkey(hotkey_or_callback):
     _hotkeys[hotkey_or_callback]()
 unregister_hotkey = clear_hotkey = remove_hotkey
 
+def remove_hotkeys(hotkeys_or_callbacks):
+    """
+    Removes many hotkeys at once, given any of the values accepted by
+    `remove_hotkey`. Raises `KeyError` without removing anything if one of
+    them is not registered.
+    """
+    removers = _collections.OrderedDict()
+    for hotkey_or_callback in hotkeys_or_callbacks:
+        removers[_hotkeys[hotkey_or_callback]] = True
+    with _listener.change_tables():
+        for remove in removers:
+            remove()
+unregister_hotkeys = remove_hotkeys
+
 def unhook_all_hotkeys():
     """
     Removes all keyboard hotkeys in use, including abbreviations, word listeners,
@@ -757,8 +1786,10 @@ def unhook_all_hotkeys():
     """
     # Because of "alises" some hooks may have more than one entry, all of which
     # are removed together.
-    _listener.blocking_hotkeys.clear()
-    _listener.nonblocking_hotkeys.clear()
+    with _listener.change_tables() as tables:
+        tables.clear('blocking_hotkeys', 'nonblocking_hotkeys')
+        tables.clear_sequences(_listener.blocking_sequences)
+        tables.clear_sequences(_listener.nonblocking_sequences)
 unregister_all_hotkeys = remove_all_hotkeys = clear_all_hotkeys = unhook_all_hotkeys
 
 def remap_hotkey(src, dst, suppress=True, trigger_on_release=False):
@@ -979,21 +2010,21 @@ def get_typed_strings(events, allow_backspace=True):
     shift_pressed = False
     capslock_pressed = False
     string = ''
-    for event in events:
-        name = event.name
+    for _, _, event_type, event_name in _iter_raw_events(events):
+        name = event_name
 
         # Space is the only key that we _parse_hotkey to the spelled out name
         # because of legibility. Now we have to undo that.
-        if event.name == 'space':
+        if event_name == 'space':
             name = ' '
 
-        if 'shift' in event.name:
-            shift_pressed = event.event_type == 'down'
-        elif event.name == 'caps lock' and event.event_type == 'down':
+        if 'shift' in event_name:
+            shift_pressed = event_type == 'down'
+        elif event_name == 'caps lock' and event_type == 'down':
             capslock_pressed = not capslock_pressed
-        elif allow_backspace and event.name == backspace_name and event.event_type == 'down':
+        elif allow_backspace and event_name == backspace_name and event_type == 'down':
             string = string[:-1]
-        elif event.event_type == 'down':
+        elif event_type == 'down':
             if len(name) == 1:
                 if shift_pressed ^ capslock_pressed:
                     name = name.upper()
@@ -1003,35 +2034,59 @@ def get_typed_strings(events, allow_backspace=True):
                 string = ''
     yield string
 
+def _iter_raw_events(events):
+    """
+    Yields `(time, scan_code, event_type, name)` for each event, reading
+    `EventBatch` columns and `load_events` records directly instead of
+    creating event objects.
+    """
+    iter_raw = getattr(events, 'iter_raw', None)
+    if iter_raw is not None:
+        return iter_raw()
+    return ((event.time, event.scan_code, event.event_type, event.name) for event in events)
+
 _recording = None
 def start_recording(recorded_events_queue=None):
     """
-    Starts recording all keyboard events into a global variable, or the given
+    Starts recording all keyboard events into a new `EventBatch`, or the given
     queue if any. Returns the queue of events and the hooked function.
 
     Use `stop_recording()` or `unhook(hooked_function)` to stop.
     """
-    recorded_events_queue = recorded_events_queue or _queue.Queue()
     global _recording
-    _recording = (recorded_events_queue, hook(recorded_events_queue.put))
+    # Leave out the events that happened before, but are still queued.
+    _listener.start_if_necessary()
+    _listener.wait_processed()
+    # `hook` keeps the callback as a dict key, and on Python 2 bound methods
+    # are hashed by their object, which an `EventBatch` can't be.
+    if recorded_events_queue is None:
+        recorded_events_queue = EventBatch()
+        put = recorded_events_queue.append
+    else:
+        put = recorded_events_queue.put
+    _recording = (recorded_events_queue, hook(lambda event: put(event)))
     return _recording
 
 def stop_recording():
     """
-    Stops the global recording of events and returns a list of the events
-    captured.
+    Stops the global recording of events and returns the events captured, as
+    an `EventBatch` (or a list, if a queue was given to `start_recording`).
     """
     global _recording
     if not _recording:
         raise ValueError('Must call "start_recording" before.')
     recorded_events_queue, hooked = _recording
+    # Include the events that happened before, but are still queued.
+    _listener.wait_processed()
     unhook(hooked)
+    if isinstance(recorded_events_queue, EventBatch):
+        return recorded_events_queue
     return list(recorded_events_queue.queue)
 
 def record(until='escape', suppress=False, trigger_on_release=False):
     """
     Records all keyboard events from all keyboards until the user presses the
-    given hotkey. Then returns the list of events recorded, of type
+    given hotkey. Then returns the events recorded, as an `EventBatch` of
     `keyboard.KeyboardEvent`. Pairs well with
     `play(events)`.
 
@@ -1054,13 +2109,13 @@ def play(events, speed_factor=1.0):
     state = stash_state()
 
     last_time = None
-    for event in events:
+    for time, scan_code, event_type, name in _iter_raw_events(events):
         if speed_factor > 0 and last_time is not None:
-            _time.sleep((event.time - last_time) / speed_factor)
-        last_time = event.time
+            _time.sleep((time - last_time) / speed_factor)
+        last_time = time
 
-        key = event.scan_code or event.name
-        press(key) if event.event_type == KEY_DOWN else release(key)
+        key = scan_code or name
+        press(key) if event_type == KEY_DOWN else release(key)
 
     restore_modifiers(state)
 replay = play
@@ -1,13 +1,71 @@
 # -*- coding: utf-8 -*-
+"""
+Prints all keyboard events to stdout and plays the events read from stdin
+(or the given files), so processes can exchange events through pipes.
+
+    python -m keyboard > events.txt
+    python -m keyboard < events.txt
+"""
 import keyboard
+import argparse
 import fileinput
 import json
 import sys
+import threading
+import time
+from keyboard._event_file import StreamWriter, StreamReader
+
+parser = argparse.ArgumentParser(prog='python -m keyboard', description=__doc__.strip().split('\n\n')[0])
+parser.add_argument('--format', choices=['json', 'binary'], default='json',
+                    help='one JSON object per line, or length-prefixed binary frames (default: json)')
+parser.add_argument('--flush-interval', type=float, default=0, metavar='SECONDS',
+                    help='buffer output and flush it at this interval, instead of after every event')
+parser.add_argument('files', nargs='*', help='files with events to play (default: stdin)')
+args = parser.parse_args()
+
+binary_stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+binary_stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+
+if args.format == 'binary':
+    writer = StreamWriter(binary_stdout)
+    write_event = writer.write
+    flush = writer.flush
+else:
+    ensure_ascii = sys.stdout.encoding != 'utf-8'
+    def write_event(event):
+        sys.stdout.write(event.to_json(ensure_ascii=ensure_ascii) + '\n')
+    flush = sys.stdout.flush
+
+# Events are written from the listener thread, and flushed either there or
+# from a timer thread.
+output_lock = threading.Lock()
+if args.flush_interval > 0:
+    def handle_event(event):
+        with output_lock:
+            write_event(event)
+
+    def flush_periodically():
+        while True:
+            time.sleep(args.flush_interval)
+            with output_lock:
+                flush()
+    flusher = threading.Thread(target=flush_periodically)
+    flusher.daemon = True
+    flusher.start()
+else:
+    def handle_event(event):
+        with output_lock:
+            write_event(event)
+            flush()
+keyboard.hook(handle_event)
 
-def print_event_json(event):
-    print(event.to_json(ensure_ascii=sys.stdout.encoding != 'utf-8'))
-    sys.stdout.flush()
-keyboard.hook(print_event_json)
+if args.format == 'binary':
+    for f in (open(path, 'rb') for path in args.files) if args.files else [binary_stdin]:
+        with f:
+            keyboard.play(StreamReader(f))
+else:
+    parse_event_json = lambda line: keyboard.KeyboardEvent(**json.loads(line))
+    keyboard.play(parse_event_json(line) for line in fileinput.input(args.files))
 
-parse_event_json = lambda line: keyboard.KeyboardEvent(**json.loads(line))
-keyboard.play(parse_event_json(line) for line in fileinput.input())
\ No newline at end of file
+with output_lock:
+    flush()
@@ -15,6 +15,10 @@ except NameError:
 
 Carbon = ctypes.cdll.LoadLibrary(ctypes.util.find_library('Carbon'))
 
+# Incremented every time a layout is loaded, so anything derived from it
+# (like parsed hotkeys) can be invalidated.
+keymap_generation = 0
+
 class KeyMap(object):
     non_layout_keys = dict((vk, normalize_name(name)) for vk, name in {
         # Layout specific keys from https://stackoverflow.com/a/16125341/252218
@@ -171,6 +175,9 @@ class KeyMap(object):
         # Cleanup
         Carbon.CFRelease(klis)
 
+        global keymap_generation
+        keymap_generation += 1
+
     def character_to_vk(self, character):
         """ Returns a tuple of (scan_code, modifiers) where ``scan_code`` is a numeric scan code
         and ``modifiers`` is an array of string modifier names (like 'shift') """
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+from array import array
+from threading import Lock
+from operator import index as _index
+from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
+# Stored in place of a missing scan code, which `array('h')` can't hold.
+_NO_SCAN_CODE = -0x8000
+_MAX_SCAN_CODE = 0x7fff
+# Interned values are indexed with `array('H')`.
+_MAX_INTERNED = 0x10000
+
+class _Columns(object):
+    """
+    Storage shared by an `EventBatch` and all slices taken from it. Only ever
+    appended to, so slices stay valid.
+    """
+    def __init__(self):
+        self.length = 0
+        self.times = array('d')
+        self.scan_codes = array('h')
+        # One bit per event, set for KEY_DOWN.
+        self.downs = bytearray()
+        self.name_indices = array('H')
+        self.context_indices = array('H')
+        # Interned values. Index 0 is always None.
+        self.names = [None]
+        self.name_index = {None: 0}
+        # (device, modifiers, is_keypad), rarely more than a handful.
+        self.contexts = [(None, None, None)]
+        self.context_index = {(None, None, None): 0}
+        self.lock = Lock()
+
+    def intern_name(self, name):
+        index = self.name_index.get(name)
+        if index is None:
+            if len(self.names) >= _MAX_INTERNED:
+                raise ValueError('EventBatch can hold at most {} distinct key names.'.format(_MAX_INTERNED))
+            index = self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def intern_context(self, context):
+        index = self.context_index.get(context)
+        if index is None:
+            if len(self.contexts) >= _MAX_INTERNED:
+                raise ValueError('EventBatch can hold at most {} distinct devices and modifiers.'.format(_MAX_INTERNED))
+            index = self.context_index[context] = len(self.contexts)
+            self.contexts.append(context)
+        return index
+
+    def append(self, event):
+        with self.lock:
+            self._append(event)
+
+    def extend(self, events):
+        with self.lock:
+            for event in events:
+                self._append(event)
+
+    def _append(self, event):
+        # Every field is checked before any column is written, so an event
+        # that can't be stored leaves the columns aligned.
+        time = float(event.time)
+        if event.scan_code is None:
+            scan_code = _NO_SCAN_CODE
+        else:
+            scan_code = _index(event.scan_code)
+            if not _NO_SCAN_CODE < scan_code <= _MAX_SCAN_CODE:
+                raise ValueError('Scan code {} out of the range EventBatch can store ({} to {}).'.format(scan_code, _NO_SCAN_CODE + 1, _MAX_SCAN_CODE))
+        name_index = self.intern_name(event.name)
+        context_index = self.intern_context((event.device, event.modifiers, event.is_keypad))
+
+        i = self.length
+        if not i & 7:
+            self.downs.append(0)
+        if event.event_type == KEY_DOWN:
+            self.downs[i >> 3] |= 1 << (i & 7)
+        self.times.append(time)
+        self.scan_codes.append(scan_code)
+        self.name_indices.append(name_index)
+        self.context_indices.append(context_index)
+        # Updated last, so readers never see a partially appended event.
+        self.length = i + 1
+
+class EventBatch(Sequence):
+    """
+    Compact sequence of keyboard events, as returned by `record` and
+    `stop_recording`. Events are stored as parallel typed arrays (times as
+    doubles, scan codes as shorts, event types as a bitmap, and indices into
+    tables of interned names and devices) instead of one object per event.
+
+    `KeyboardEvent` objects are only created when an item is accessed.
+    Slicing returns another `EventBatch` sharing the same storage, without
+    copying. Analytics can read the raw columns with `times`, `scan_codes`,
+    `names` and `iter_raw` without creating any event objects.
+    """
+    def __init__(self, events=()):
+        self._columns = _Columns()
+        self._start = 0
+        # Unbounded batches see new events as they are appended.
+        self._stop = None
+        self.extend(events)
+
+    def _bounds(self):
+        return self._start, self._columns.length if self._stop is None else self._stop
+
+    def append(self, event):
+        """ Appends a `KeyboardEvent`. Slices are read-only. """
+        if self._stop is not None or self._start:
+            raise TypeError('Slices of an EventBatch are read-only.')
+        self._columns.append(event)
+    # So it can be used as `start_recording` target, like a Queue.
+    put = append
+
+    def extend(self, events):
+        """ Appends many events, taking the lock only once. """
+        if self._stop is not None or self._start:
+            raise TypeError('Slices of an EventBatch are read-only.')
+        self._columns.extend(events)
+
+    def __len__(self):
+        start, stop = self._bounds()
+        return stop - start
+
+    def _materialize(self, i):
+        columns = self._columns
+        scan_code = columns.scan_codes[i]
+        device, modifiers, is_keypad = columns.contexts[columns.context_indices[i]]
+        return KeyboardEvent._from_trusted(
+            KEY_DOWN if columns.downs[i >> 3] >> (i & 7) & 1 else KEY_UP,
+            None if scan_code == _NO_SCAN_CODE else scan_code,
+            columns.names[columns.name_indices[i]],
+            columns.times[i],
+            device,
+            modifiers,
+            is_keypad,
+        )
+
+    def __getitem__(self, index):
+        start, stop = self._bounds()
+        if isinstance(index, slice):
+            slice_start, slice_stop, step = index.indices(stop - start)
+            if step != 1:
+                return [self[i] for i in range(slice_start, slice_stop, step)]
+            view = EventBatch.__new__(EventBatch)
+            view._columns = self._columns
+            view._start = start + slice_start
+            view._stop = start + max(slice_start, slice_stop)
+            return view
+
+        if index < 0:
+            index += stop - start
+        if not 0 <= index < stop - start:
+            raise IndexError('EventBatch index out of range')
+        return self._materialize(start + index)
+
+    def __iter__(self):
+        start, stop = self._bounds()
+        for i in range(start, stop):
+            yield self._materialize(i)
+
+    def iter_raw(self):
+        """
+        Yields `(time, scan_code, event_type, name)` for each event, without
+        creating `KeyboardEvent` objects.
+        """
+        columns = self._columns
+        start, stop = self._bounds()
+        downs = columns.downs
+        names = columns.names
+        for i in range(start, stop):
+            scan_code = columns.scan_codes[i]
+            yield (
+                columns.times[i],
+                None if scan_code == _NO_SCAN_CODE else scan_code,
+                KEY_DOWN if downs[i >> 3] >> (i & 7) & 1 else KEY_UP,
+                names[columns.name_indices[i]],
+            )
+
+    @property
+    def times(self):
+        """ Copy of the event timestamps, as `array('d')`. """
+        start, stop = self._bounds()
+        return self._columns.times[start:stop]
+
+    @property
+    def scan_codes(self):
+        """ Copy of the event scan codes, as `array('h')` (-32768 for none). """
+        start, stop = self._bounds()
+        return self._columns.scan_codes[start:stop]
+
+    @property
+    def names(self):
+        """ List of event names. Repeated names are the same object. """
+        columns = self._columns
+        start, stop = self._bounds()
+        names = columns.names
+        return [names[i] for i in columns.name_indices[start:stop]]
+
+    def __eq__(self, other):
+        if not isinstance(other, (Sequence, list, tuple)) or len(self) != len(other):
+            return False
+        return all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return EventBatch, (list(self),)
+
+    def __repr__(self):
+        return 'EventBatch({} events)'.format(len(self))
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Binary format for recorded keyboard events.
+
+    header:  magic, version, record size, event count, string table offset
+    records: one fixed-width record per event
+    strings: names and devices referenced by the records, index 0 being None
+
+The same fields as `KeyboardEvent.to_json` are stored. Records are read
+straight from an `mmap`, so captures larger than memory can be replayed.
+
+For pipes, where the file can't be rewritten at the end, the stream variant
+starts with its own magic and is followed by length-prefixed frames, each
+either a string appended to the table or a run of records.
+"""
+import io
+import mmap
+import struct
+from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP
+
+MAGIC = b'KBEV'
+VERSION = 1
+header_struct = struct.Struct('<4sHHQQ')
+# time, scan code, name index, device index, flags.
+record_struct = struct.Struct('<dhHHBx')
+string_length_struct = struct.Struct('<H')
+count_struct = struct.Struct('<I')
+
+STREAM_MAGIC = b'KBES'
+stream_header_struct = struct.Struct('<4sH')
+frame_struct = struct.Struct('<cI')
+FRAME_STRING = b'S'
+FRAME_RECORDS = b'R'
+
+if hasattr(record_struct, 'iter_unpack'):
+    unpack_records = record_struct.iter_unpack
+else:
+    # Python 2.
+    def unpack_records(data):
+        return (record_struct.unpack_from(data, i) for i in range(0, len(data), record_struct.size))
+
+NO_SCAN_CODE = -0x8000
+FLAG_DOWN = 1
+FLAG_HAS_KEYPAD = 2
+FLAG_KEYPAD = 4
+
+# Records are buffered and written in chunks of this many events.
+records_per_write = 4096
+
+class StringTable(object):
+    """ Interns strings, assigning sequential indices. """
+    def __init__(self):
+        self.strings = [None]
+        self.indices = {None: 0}
+
+    def index(self, string):
+        index = self.indices.get(string)
+        if index is None:
+            if len(self.strings) > 0xFFFF:
+                raise ValueError('Too many distinct names to save.')
+            index = self.indices[string] = len(self.strings)
+            self.strings.append(string)
+        return index
+
+    def pack(self):
+        chunks = [count_struct.pack(len(self.strings) - 1)]
+        for string in self.strings[1:]:
+            data = string.encode('utf-8')
+            chunks.append(string_length_struct.pack(len(data)))
+            chunks.append(data)
+        return b''.join(chunks)
+
+def unpack_strings(data, offset):
+    count, = count_struct.unpack_from(data, offset)
+    offset += count_struct.size
+    strings = [None]
+    for _ in range(count):
+        length, = string_length_struct.unpack_from(data, offset)
+        offset += string_length_struct.size
+        strings.append(data[offset:offset+length].decode('utf-8'))
+        offset += length
+    return strings
+
+def pack_event(event, strings):
+    flags = FLAG_DOWN if event.event_type == KEY_DOWN else 0
+    if event.is_keypad is not None:
+        flags |= FLAG_HAS_KEYPAD | (FLAG_KEYPAD if event.is_keypad else 0)
+    return record_struct.pack(
+        event.time or 0,
+        NO_SCAN_CODE if event.scan_code is None else event.scan_code,
+        strings.index(event.name),
+        strings.index(event.device),
+        flags,
+    )
+
+def unpack_event(record, strings):
+    time, scan_code, name, device, flags = record
+    return KeyboardEvent._from_trusted(
+        KEY_DOWN if flags & FLAG_DOWN else KEY_UP,
+        None if scan_code == NO_SCAN_CODE else scan_code,
+        strings[name],
+        time,
+        strings[device],
+        None,
+        bool(flags & FLAG_KEYPAD) if flags & FLAG_HAS_KEYPAD else None,
+    )
+
+def save_events(path, events):
+    """
+    Writes a sequence of events (e.g. from `record`) to the file at `path`,
+    in a compact binary format. Events are consumed as they are written, so
+    this can also save from a generator. Returns the number of events saved.
+    """
+    strings = StringTable()
+    count = 0
+    with io.open(path, 'wb') as f:
+        f.write(header_struct.pack(MAGIC, VERSION, record_struct.size, 0, 0))
+        chunk = []
+        for event in events:
+            chunk.append(pack_event(event, strings))
+            if len(chunk) >= records_per_write:
+                f.write(b''.join(chunk))
+                count += len(chunk)
+                del chunk[:]
+        f.write(b''.join(chunk))
+        count += len(chunk)
+
+        strings_offset = f.tell()
+        f.write(strings.pack())
+        f.seek(0)
+        f.write(header_struct.pack(MAGIC, VERSION, record_struct.size, count, strings_offset))
+    return count
+
+class RecordReader(object):
+    """
+    Base for sequences of records, with subclasses providing `_strings` and
+    `_iter_records`.
+    """
+    def __iter__(self):
+        strings = self._strings
+        for record in self._iter_records():
+            yield unpack_event(record, strings)
+
+    def iter_raw(self):
+        """
+        Yields `(time, scan_code, event_type, name)` for each event, without
+        creating `KeyboardEvent` objects.
+        """
+        strings = self._strings
+        for time, scan_code, name, _, flags in self._iter_records():
+            yield (
+                time,
+                None if scan_code == NO_SCAN_CODE else scan_code,
+                KEY_DOWN if flags & FLAG_DOWN else KEY_UP,
+                strings[name],
+            )
+
+class EventFile(RecordReader):
+    """
+    Read-only sequence of the events in a file written by `save_events`.
+    Records are decoded on access from a memory map of the file, so only the
+    name table is loaded up front.
+    """
+    def __init__(self, path):
+        with io.open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._map) < header_struct.size:
+                raise ValueError('Not a keyboard events file: {}'.format(path))
+            magic, version, record_size, count, strings_offset = header_struct.unpack_from(self._map, 0)
+            if magic != MAGIC or record_size != record_struct.size:
+                raise ValueError('Not a keyboard events file: {}'.format(path))
+            if version != VERSION:
+                raise ValueError('Unsupported keyboard events file version: {}'.format(version))
+            self._count = count
+            self._strings = unpack_strings(self._map, strings_offset)
+        except:
+            self._map.close()
+            raise
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('EventFile index out of range')
+        record = record_struct.unpack_from(self._map, header_struct.size + index * record_struct.size)
+        return unpack_event(record, self._strings)
+
+    def _iter_records(self):
+        # Only one chunk at a time is copied out of the map.
+        end = header_struct.size + self._count * record_struct.size
+        chunk_size = records_per_write * record_struct.size
+        for offset in range(header_struct.size, end, chunk_size):
+            for record in unpack_records(self._map[offset:min(offset + chunk_size, end)]):
+                yield record
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return 'EventFile({} events)'.format(self._count)
+
+def load_events(path):
+    """
+    Opens a file written by `save_events` and returns a read-only sequence of
+    its events. Events are decoded lazily from a memory map, so large
+    captures can be passed to `play` without loading them into memory. Use
+    as a context manager, or call `.close()`, to release the file.
+    """
+    return EventFile(path)
+
+class StreamWriter(object):
+    """
+    Encodes events into the stream variant of the format, buffering them
+    until `flush` is called. Not thread safe.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.strings = StringTable()
+        self.buffer = bytearray(stream_header_struct.pack(STREAM_MAGIC, VERSION))
+        self.records = bytearray()
+
+    def write(self, event):
+        known = len(self.strings.strings)
+        record = pack_event(event, self.strings)
+        for string in self.strings.strings[known:]:
+            # Pending records can't reference the new string, so they go first.
+            self._end_records()
+            data = string.encode('utf-8')
+            self.buffer += frame_struct.pack(FRAME_STRING, len(data))
+            self.buffer += data
+        self.records += record
+
+    def _end_records(self):
+        if self.records:
+            self.buffer += frame_struct.pack(FRAME_RECORDS, len(self.records))
+            self.buffer += self.records
+            del self.records[:]
+
+    def flush(self):
+        self._end_records()
+        if self.buffer:
+            self.f.write(bytes(self.buffer))
+            del self.buffer[:]
+        self.f.flush()
+
+class StreamReader(RecordReader):
+    """
+    Decodes events from a stream written by `StreamWriter` as they arrive,
+    one frame at a time. Can only be iterated once.
+    """
+    def __init__(self, f):
+        self.f = f
+        self._strings = [None]
+
+    def _read(self, size, allow_eof=False):
+        data = self.f.read(size)
+        if len(data) != size:
+            if allow_eof and not data:
+                return None
+            raise ValueError('Truncated keyboard events stream.')
+        return data
+
+    def _iter_records(self):
+        header = self._read(stream_header_struct.size, allow_eof=True)
+        if header is None:
+            # Nothing was written, like an empty pipe.
+            return
+        magic, version = stream_header_struct.unpack(header)
+        if magic != STREAM_MAGIC:
+            raise ValueError('Not a keyboard events stream.')
+        if version != VERSION:
+            raise ValueError('Unsupported keyboard events stream version: {}'.format(version))
+        while True:
+            header = self._read(frame_struct.size, allow_eof=True)
+            if header is None:
+                return
+            kind, length = frame_struct.unpack(header)
+            data = self._read(length)
+            if kind == FRAME_STRING:
+                self._strings.append(data.decode('utf-8'))
+            elif kind == FRAME_RECORDS:
+                for record in unpack_records(data):
+                    yield record
+            else:
+                raise ValueError('Unknown frame in keyboard events stream: {!r}'.format(kind))
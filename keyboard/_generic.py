@@ -1,30 +1,270 @@
 # -*- coding: utf-8 -*-
-from threading import Thread, Lock
+from threading import Thread, Lock, current_thread
+from collections import deque
+import bisect
+import time
 import traceback
 import functools
 
+timer = getattr(time, 'perf_counter', time.time)
+
 try:
     from queue import Queue
 except ImportError:
     from Queue import Queue
 
+def describe(handler):
+    """
+    Returns a readable name for a handler, like 'module.function', looking
+    through wrappers that set `__wrapped__`.
+    """
+    while getattr(handler, '__wrapped__', None) is not None:
+        handler = handler.__wrapped__
+    name = getattr(handler, '__qualname__', None) or getattr(handler, '__name__', None)
+    if name is None:
+        return repr(handler)
+    module = getattr(handler, '__module__', None)
+    return '{}.{}'.format(module, name) if module else name
+
+# Upper bounds of the latency histogram buckets, in seconds.
+latency_buckets = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1, float('inf'))
+
+class HandlerStats(object):
+    """
+    Call counts and latency histograms for each handler called through
+    `call`. If `slow_threshold` (in seconds) is given, `on_slow(name,
+    duration)` is called on the handler's thread every time a handler takes
+    longer than that.
+    """
+    def __init__(self, slow_threshold=None, on_slow=None):
+        self.slow_threshold = slow_threshold
+        self.on_slow = on_slow
+        self.lock = Lock()
+        # Handler -> [calls, total time, max time, histogram].
+        self.entries = {}
+
+    def call(self, handler, *args):
+        """ Calls `handler(*args)`, recording how long it took. """
+        start = timer()
+        try:
+            return handler(*args)
+        finally:
+            self.record(handler, timer() - start)
+
+    def record(self, handler, duration):
+        with self.lock:
+            entry = self.entries.get(handler)
+            if entry is None:
+                entry = self.entries[handler] = [0, 0.0, 0.0, [0] * len(latency_buckets)]
+            entry[0] += 1
+            entry[1] += duration
+            if duration > entry[2]:
+                entry[2] = duration
+            entry[3][bisect.bisect_left(latency_buckets, duration)] += 1
+
+        if self.slow_threshold is not None and duration > self.slow_threshold and self.on_slow:
+            try:
+                self.on_slow(describe(handler), duration)
+            except Exception as e:
+                traceback.print_exc()
+
+    def forget(self, handlers):
+        """ Drops the entries of removed handlers. """
+        with self.lock:
+            for handler in handlers:
+                self.entries.pop(handler, None)
+
+    def snapshot(self):
+        """
+        Returns a list with a dict for each handler called: its `name`,
+        `calls`, `total` and `max` time, and `histogram`, a list of (upper
+        bound in seconds, count). Sorted by total time, slowest first.
+        """
+        with self.lock:
+            entries = [(handler, calls, total, max_, list(histogram)) for handler, (calls, total, max_, histogram) in self.entries.items()]
+        return sorted((
+            {
+                'name': describe(handler),
+                'calls': calls,
+                'total': total,
+                'max': max_,
+                'histogram': list(zip(latency_buckets, histogram)),
+            }
+            for handler, calls, total, max_, histogram in entries
+        ), key=lambda entry: -entry['total'])
+
+class EventQueue(Queue):
+    """
+    Queue between the OS hook and the processing thread, holding up to
+    `maxsize` items (0 for no limit). When full, `policy` decides what
+    happens to a new item:
+
+    - 'block': waits for room, like `Queue`. This delays the OS hook, and
+    with it the user's input, until handlers catch up.
+    - 'drop_oldest': discards the oldest item to make room.
+    - 'drop_newest': discards the new item.
+    - 'coalesce': if the new item is a repeat (e.g. a key held down), as
+    given by `repeat_key`, discards the queued item it repeats and queues the
+    new one at the end, so the latest state is kept. Other items are queued
+    past the limit, so no press or release is lost.
+
+    Discarded items are counted in `dropped`, and `high_water` is the largest
+    size the queue has reached.
+    """
+    policies = ('block', 'drop_oldest', 'drop_newest', 'coalesce')
+
+    def __init__(self, maxsize=0, policy='block', repeat_key=None):
+        Queue.__init__(self, maxsize)
+        if policy not in self.policies:
+            raise ValueError('Unknown queue policy {!r}, expected one of {}.'.format(policy, self.policies))
+        self.policy = policy
+        # Returns (key, is_repeatable) for an item. It's a repeat if the
+        # previous item with the same key was repeatable too.
+        self.repeat_key = repeat_key or (lambda item: (None, False))
+        self.last_repeatable = {}
+        self.dropped = 0
+        self.high_water = 0
+        # Items ever queued, and marked done or discarded, for `join_queued`.
+        self.queued = 0
+        self.finished = 0
+
+    def configure(self, maxsize=0, policy='block'):
+        """ Changes the size limit and the policy for when it's reached. """
+        if policy not in self.policies:
+            raise ValueError('Unknown queue policy {!r}, expected one of {}.'.format(policy, self.policies))
+        with self.mutex:
+            self.maxsize = maxsize
+            self.policy = policy
+            self.not_full.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == 'block':
+            return Queue.put(self, item, block, timeout)
+
+        with self.mutex:
+            is_repeat = False
+            if self.policy == 'coalesce':
+                key, is_repeatable = self.repeat_key(item)
+                is_repeat = is_repeatable and self.last_repeatable.get(key, False)
+                self.last_repeatable[key] = is_repeatable
+
+            if 0 < self.maxsize <= self._qsize():
+                if self.policy == 'drop_oldest':
+                    self.queue.popleft()
+                    self.unfinished_tasks -= 1
+                    self.finished += 1
+                    self.dropped += 1
+                elif self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return
+                elif is_repeat and self._discard_repeated(key):
+                    self.unfinished_tasks -= 1
+                    self.finished += 1
+                    self.dropped += 1
+
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _discard_repeated(self, key):
+        # Removes the latest queued item with this key. Nothing with the same
+        # key came after it, or the new item wouldn't be a repeat, so the
+        # order of the remaining items is preserved.
+        for i in range(len(self.queue) - 1, -1, -1):
+            if self.repeat_key(self.queue[i])[0] == key:
+                del self.queue[i]
+                return True
+        return False
+
+    def _put(self, item):
+        self.queue.append(item)
+        self.queued += 1
+        if len(self.queue) > self.high_water:
+            self.high_water = len(self.queue)
+
+    def get_all(self):
+        """
+        Blocks until an item is available, then removes and returns all
+        queued items as a list, in a single locked operation.
+        """
+        with self.not_empty:
+            while not self._qsize():
+                self.not_empty.wait()
+            items = list(self.queue)
+            self.queue.clear()
+            self.not_full.notify_all()
+            return items
+
+    def task_done(self, count=1):
+        """ Like `Queue.task_done`, for `count` items at once. """
+        with self.all_tasks_done:
+            unfinished = self.unfinished_tasks - count
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks = unfinished
+            self.finished += count
+            self.all_tasks_done.notify_all()
+
+    def join_queued(self):
+        """
+        Like `join`, but only waits for the items queued so far, so it returns
+        even if new items keep arriving.
+        """
+        with self.all_tasks_done:
+            target = self.queued
+            while self.finished < target:
+                self.all_tasks_done.wait()
+
+    def stats(self):
+        """
+        Returns a dict with the current `size`, `maxsize` and `policy`, and
+        the totals `dropped` and `high_water`.
+        """
+        with self.mutex:
+            return {
+                'size': self._qsize(),
+                'maxsize': self.maxsize,
+                'policy': self.policy,
+                'dropped': self.dropped,
+                'high_water': self.high_water,
+            }
+
 class GenericListener(object):
     lock = Lock()
 
     def __init__(self):
-        self.handlers = []
+        # Replaced instead of modified, so the processing thread can iterate
+        # it while handlers are added or removed.
+        self.handlers = ()
+        # Handlers that receive a list of events at a time.
+        self.batch_handlers = ()
+        # A HandlerStats while handler timing is enabled.
+        self.handler_stats = None
+        self.handlers_lock = Lock()
         self.listening = False
-        self.queue = Queue()
+        self.queue = EventQueue(repeat_key=self.repeat_key)
 
     def invoke_handlers(self, event):
+        stats = self.handler_stats
         for handler in self.handlers:
             try:
-                if handler(event):
+                if stats.call(handler, event) if stats else handler(event):
                     # Stop processing this hotkey.
                     return 1
             except Exception as e:
                 traceback.print_exc()
 
+    def invoke_batch_handlers(self, events, batch_handlers):
+        stats = self.handler_stats
+        for handler in batch_handlers:
+            try:
+                if stats:
+                    stats.call(handler, events)
+                else:
+                    handler(events)
+            except Exception as e:
+                traceback.print_exc()
+
     def start_if_necessary(self):
         """
         Starts the listening thread if it wasn't already.
@@ -45,29 +285,177 @@ class GenericListener(object):
         finally:
             self.lock.release()
 
-    def pre_process_event(self, event):
+    def repeat_key(self, item):
+        """
+        Returns `(key, is_repeatable)` for a queue item, so the 'coalesce'
+        policy of `EventQueue` can recognize repeated events. By default
+        nothing is a repeat.
+        """
+        return None, False
+
+    def pre_process_event(self, item):
+        """
+        Receives each item from the queue, and returns the event to pass to
+        the handlers, or None to skip them.
+        """
         raise NotImplementedError('This method should be implemented in the child class.')
 
     def process(self):
         """
         Loops over the underlying queue of events and processes them in order.
+        Takes all queued events at once, so batch handlers receive every
+        event that arrived while the previous batch was processed.
         """
         assert self.queue is not None
         while True:
-            event = self.queue.get()
-            if self.pre_process_event(event):
-                self.invoke_handlers(event)
-            self.queue.task_done()
-            
-    def add_handler(self, handler):
+            items = self.queue.get_all()
+            # Batch handlers get the events processed after they were added,
+            # and are called even if removed by a handler in the meantime.
+            batch_handlers = self.batch_handlers
+            events = []
+            for item in items:
+                event = self.pre_process_event(item)
+                if event and not self.invoke_handlers(event):
+                    events.append(event)
+            if events and batch_handlers:
+                self.invoke_batch_handlers(events, batch_handlers)
+            self.queue.task_done(len(items))
+
+    def wait_processed(self):
+        """
+        Waits until the events captured so far went through the handlers.
+        Does nothing when called from a handler, which would wait on itself.
+        """
+        if current_thread() is not getattr(self, 'processing_thread', None):
+            self.queue.join_queued()
+
+    def add_handler(self, handler, batch=False):
         """
         Adds a function to receive each event captured, starting the capturing
-        process if necessary.
+        process if necessary. With `batch`, the function receives lists of
+        events instead, after the other handlers.
         """
         self.start_if_necessary()
-        self.handlers.append(handler)
+        with self.handlers_lock:
+            if batch:
+                self.batch_handlers = self.batch_handlers + (handler,)
+            else:
+                self.handlers = self.handlers + (handler,)
 
     def remove_handler(self, handler):
         """ Removes a previously added event handler. """
-        while handler in self.handlers:
-            self.handlers.remove(handler)
+        with self.handlers_lock:
+            self.handlers = tuple(h for h in self.handlers if h != handler)
+            self.batch_handlers = tuple(h for h in self.batch_handlers if h != handler)
+        self.forget_handlers((handler,))
+
+    def remove_all_handlers(self):
+        """ Removes all event handlers. """
+        with self.handlers_lock:
+            removed = self.handlers + self.batch_handlers
+            self.handlers = ()
+            self.batch_handlers = ()
+        self.forget_handlers(removed)
+
+    def forget_handlers(self, handlers):
+        """ Drops the stats of removed handlers, so they can be collected. """
+        stats = self.handler_stats
+        if stats:
+            stats.forget(handlers)
+
+class CallbackExecutor(object):
+    """
+    Pool of worker threads to run slow callbacks outside of the listener
+    threads, passed as `executor` to functions like `hook` and `add_hotkey`.
+
+    Calls to the same handler run one at a time, in the order the events
+    happened, while different handlers run in parallel on up to
+    `max_workers` threads. At most `max_pending` calls wait to run; calls
+    past that are dropped and counted in `rejected`, instead of delaying the
+    listener.
+    """
+    def __init__(self, max_workers=4, max_pending=1000):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.lock = Lock()
+        # Handler -> deque of pending argument tuples. A handler is in
+        # `lanes` while it has calls pending or running.
+        self.lanes = {}
+        # Handlers with calls pending and no worker running them.
+        self.ready = Queue()
+        self.workers = []
+        self.idle_workers = 0
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def submit(self, handler, *args):
+        """
+        Schedules `handler(*args)` after the calls already pending for that
+        handler. Returns False if the call was rejected because too many are
+        pending.
+        """
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            lane = self.lanes.get(handler)
+            if lane is None:
+                lane = self.lanes[handler] = deque()
+                self.ready.put(handler)
+                if self.ready.qsize() > self.idle_workers and len(self.workers) < self.max_workers:
+                    worker = Thread(target=self._work)
+                    worker.daemon = True
+                    worker.start()
+                    self.workers.append(worker)
+                    self.idle_workers += 1
+            lane.append(args)
+            return True
+
+    def wrap(self, callback):
+        """
+        Returns a function that submits its arguments to `callback` and
+        returns None, for use as a handler.
+        """
+        def handler(*args):
+            self.submit(callback, *args)
+        handler.__wrapped__ = callback
+        return handler
+
+    def _work(self):
+        while True:
+            handler = self.ready.get()
+            with self.lock:
+                self.idle_workers -= 1
+                args = self.lanes[handler].popleft()
+                self.pending -= 1
+                self.running += 1
+            try:
+                handler(*args)
+            except Exception as e:
+                traceback.print_exc()
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.idle_workers += 1
+                if self.lanes[handler]:
+                    # Back of the line, so busy handlers don't starve others.
+                    self.ready.put(handler)
+                else:
+                    del self.lanes[handler]
+
+    def stats(self):
+        """
+        Returns a dict with the number of calls `pending` and `running`, and
+        the totals `completed` and `rejected`.
+        """
+        with self.lock:
+            return {
+                'pending': self.pending,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'workers': len(self.workers),
+            }
@@ -13,13 +13,8 @@ KEY_DOWN = 'down'
 KEY_UP = 'up'
 
 class KeyboardEvent(object):
-    event_type = None
-    scan_code = None
-    name = None
-    time = None
-    device = None
-    modifiers = None
-    is_keypad = None
+    # Recordings may hold millions of events, so avoid a per-instance dict.
+    __slots__ = ('event_type', 'scan_code', 'name', 'time', 'device', 'modifiers', 'is_keypad')
 
     def __init__(self, event_type, scan_code, name=None, time=None, device=None, modifiers=None, is_keypad=None):
         self.event_type = event_type
@@ -28,8 +23,37 @@ class KeyboardEvent(object):
         self.device = device
         self.is_keypad = is_keypad
         self.modifiers = modifiers
-        if name:
-            self.name = normalize_name(name)
+        self.name = normalize_name(name) if name else None
+
+    @classmethod
+    def _from_trusted(cls, event_type, scan_code, name, time, device=None, modifiers=None, is_keypad=None):
+        """
+        Fast constructor for backends that already have a normalized name (or
+        None) and a timestamp. No validation is done.
+        """
+        event = cls.__new__(cls)
+        event.event_type = event_type
+        event.scan_code = scan_code
+        event.name = name
+        event.time = time
+        event.device = device
+        event.modifiers = modifiers
+        event.is_keypad = is_keypad
+        return event
+
+    # Slotted objects need explicit state for pickle protocols 0 and 1.
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before the class had slots. Attributes left at their
+            # None default were not in the instance dict.
+            for attr in self.__slots__:
+                setattr(self, attr, state.get(attr))
+            return
+        for attr, value in zip(self.__slots__, state):
+            setattr(self, attr, value)
 
     def to_json(self, ensure_ascii=False):
         attrs = dict(
@@ -16,6 +16,10 @@ from __future__ import print_function
 
 import unittest
 import time
+import threading
+import os
+import io
+import select
 
 import keyboard
 from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP
@@ -60,7 +64,8 @@ def send_instant_event(event):
     if keyboard._listener.direct_callback(event):
         output_events.append(event)
 
-# Mock out side effects.
+# Mock out side effects, keeping the real listener for the backend tests.
+os_listen = keyboard._os_keyboard.listen
 keyboard._os_keyboard.init = lambda: None
 keyboard._os_keyboard.listen = lambda callback: None
 keyboard._os_keyboard.map_name = dummy_keys.__getitem__
@@ -94,6 +99,19 @@ d_space = [make_event(KEY_DOWN, 'space')]
 u_space = [make_event(KEY_UP, 'space')]
 du_space = [make_event(KEY_DOWN, 'space'), make_event(KEY_UP, 'space')]
 
+def make_pipe_device(path, raw_events):
+    """
+    Returns an evdev `EventDevice` that reads the given `(seconds,
+    microseconds, type, code, value)` events from a pipe, then hangs up.
+    """
+    from ._nixcommon import EventDevice, event_struct
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b''.join(event_struct.pack(*raw_event) for raw_event in raw_events))
+    os.close(write_fd)
+    device = EventDevice(path)
+    device._input_file = io.open(read_fd, 'rb', 0)
+    return device
+
 trigger = lambda e=None: keyboard.press(999)
 triggered_event = [KeyboardEvent(KEY_DOWN, scan_code=999)]
 
@@ -134,6 +152,46 @@ class TestKeyboard(unittest.TestCase):
         import json
         self.assertEqual(event, KeyboardEvent(**json.loads(event.to_json())))
 
+    def test_event_from_trusted(self):
+        event = KeyboardEvent._from_trusted(KEY_DOWN, 1, 'a', 5)
+        self.assertEqual(event, make_event(KEY_DOWN, 'a'))
+        self.assertEqual(event.time, 5)
+        self.assertIsNone(event.device)
+    def test_event_pickle(self):
+        import pickle
+        event = make_event(KEY_DOWN, 'a', time=5)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(event, protocol))
+            self.assertEqual(copy, event)
+            self.assertEqual(copy.time, 5)
+    def test_event_unpickle_dict_state(self):
+        import pickle
+        # Pickled with protocols 0 and 2 before KeyboardEvent had slots.
+        for data in [
+                b'ccopy_reg\n_reconstructor\np0\n(ckeyboard._keyboard_event\nKeyboardEvent\np1\nc__builtin__\nobject\np2\nNtp3\nRp4\n(dp5\nVevent_type\np6\nVdown\np7\nsVscan_code\np8\nI30\nsVtime\np9\nI5\nsVdevice\np10\nNsVis_keypad\np11\nNsVmodifiers\np12\nNsb.',
+                b'\x80\x02ckeyboard._keyboard_event\nKeyboardEvent\nq\x00)\x81q\x01}q\x02(X\n\x00\x00\x00event_typeq\x03X\x04\x00\x00\x00downq\x04X\t\x00\x00\x00scan_codeq\x05K\x1eX\x04\x00\x00\x00timeq\x06K\x05X\x06\x00\x00\x00deviceq\x07NX\t\x00\x00\x00is_keypadq\x08NX\t\x00\x00\x00modifiersq\tNub.',
+            ]:
+            event = pickle.loads(data)
+            self.assertEqual((event.event_type, event.scan_code, event.time, event.name), (KEY_DOWN, 30, 5, None))
+
+    def test_pressed_events_key(self):
+        pressed = keyboard._PressedEvents({5: d_shift[0], 1: d_a[0]})
+        self.assertEqual(pressed.key, (1, 5))
+        pressed[3] = d_c[0]
+        pressed[3] = d_c[0]
+        self.assertEqual(pressed.key, (1, 3, 5))
+        del pressed[1]
+        self.assertEqual(pressed.pop(5), d_shift[0])
+        self.assertEqual(pressed.pop(5, None), None)
+        self.assertEqual(pressed.key, (3,))
+        pressed.set_classes({5: 100, 6: 100})
+        pressed[6] = d_shift[0]
+        self.assertEqual(pressed.lookup_keys, ((3, 6), (3, 100)))
+        del pressed[6]
+        self.assertEqual(pressed.lookup_keys, ((3,),))
+        pressed.clear()
+        self.assertEqual(pressed.key, ())
+
     def test_is_modifier_name(self):
         for name in keyboard.all_modifiers:
             self.assertTrue(keyboard.is_modifier(name))
@@ -232,10 +290,51 @@ class TestKeyboard(unittest.TestCase):
     def test_is_pressed_hotkey_false(self):
         self.do(d_shift+d_a+u_a)
         self.assertFalse(keyboard.is_pressed('shift+a'))
+    def test_is_pressed_held_at_startup(self):
+        keyboard._os_keyboard.init = lambda: d_shift+d_a
+        try:
+            keyboard._listener.init()
+        finally:
+            keyboard._os_keyboard.init = lambda: None
+        self.assertTrue(keyboard.is_pressed('shift+a'))
+        self.do(u_a)
+        self.assertFalse(keyboard.is_pressed('shift+a'))
+        self.assertTrue(keyboard.is_pressed('shift'))
     def test_is_pressed_multi_step_fail(self):
         self.do(u_a+d_a)
         with self.assertRaises(ValueError):
             keyboard.is_pressed('a, b')
+    def test_compile_pressed_check(self):
+        shift_a = keyboard.compile_pressed_check('shift+a')
+        self.assertFalse(shift_a())
+        self.do(d_shift+d_a)
+        self.assertTrue(shift_a())
+        self.do(u_a)
+        self.assertFalse(shift_a())
+        with self.assertRaises(ValueError):
+            keyboard.compile_pressed_check('a, b')
+    def test_are_pressed(self):
+        self.do(d_shift+d_a)
+        shift_b = keyboard.compile_pressed_check('shift+b')
+        self.assertEqual(keyboard.are_pressed(['shift', 'a', 'shift+a', shift_b, 'left shift']), [True, True, True, False, True])
+
+    def test_snapshot(self):
+        version, scan_codes = keyboard.snapshot()
+        self.assertEqual(scan_codes, frozenset())
+        self.do(d_a+d_a)
+        state = keyboard.snapshot()
+        self.assertEqual(state.version, version + 1)
+        self.assertEqual(state.scan_codes, frozenset([1]))
+    def test_wait_for_state_change(self):
+        version = keyboard.snapshot().version
+        self.assertIsNone(keyboard.wait_for_state_change(version, timeout=0.01))
+        queue = keyboard._queue.Queue()
+        thread = threading.Thread(target=lambda: queue.put(keyboard.wait_for_state_change(version, timeout=1)))
+        thread.start()
+        self.do(d_a)
+        thread.join()
+        self.assertEqual(queue.get_nowait(), (version + 1, frozenset([1])))
+        self.assertEqual(keyboard.wait_for_state_change(version).version, version + 1)
 
     def test_send_single_press_release(self):
         keyboard.send('a', do_press=True, do_release=True)
@@ -359,6 +458,175 @@ class TestKeyboard(unittest.TestCase):
     def test_on_press_key_blocking(self):
         keyboard.on_press_key('A', lambda e: e.scan_code == 1, suppress=True)
         self.do([make_event(KEY_DOWN, 'A', -1)] + d_a, d_a)
+    def test_executor(self):
+        executor = keyboard.CallbackExecutor(max_workers=2)
+        queue = keyboard._queue.Queue()
+        keyboard.hook(lambda e: queue.put(e.name), executor=executor)
+        keyboard.add_hotkey('c', lambda: queue.put('hotkey'), suppress=True, executor=executor)
+        keyboard.on_press(lambda e: queue.put('press'), executor=executor)
+        self.do(du_a+du_b+d_c, du_a+du_b)
+        results = [queue.get(timeout=0.5) for i in range(9)]
+        self.assertEqual([r for r in results if len(r) == 1], ['a', 'a', 'b', 'b', 'c'])
+        self.assertEqual(results.count('press'), 3)
+        self.assertEqual(results.count('hotkey'), 1)
+        with self.assertRaises(ValueError):
+            keyboard.hook(trigger, suppress=True, executor=executor)
+        with self.assertRaises(ValueError):
+            keyboard.on_press_key('a', trigger, suppress=True, executor=executor)
+    def test_executor_rejected(self):
+        executor = keyboard.CallbackExecutor(max_workers=1, max_pending=1)
+        started, finish = threading.Event(), threading.Event()
+        blocked = lambda: started.set() or finish.wait()
+        self.assertTrue(executor.submit(blocked))
+        started.wait()
+        self.assertTrue(executor.submit(blocked))
+        self.assertFalse(executor.submit(blocked))
+        stats = executor.stats()
+        self.assertEqual((stats['running'], stats['pending'], stats['rejected']), (1, 1, 1))
+        finish.set()
+    def test_event_queue_policies(self):
+        from ._generic import EventQueue
+        items = [(e, ()) for e in d_a+d_a+d_b+d_a+u_a]
+        names = lambda queue: [('d_' if e.event_type == KEY_DOWN else 'u_') + e.name for e, _ in queue.queue]
+
+        queue = EventQueue(3, 'drop_oldest')
+        for item in items: queue.put(item)
+        self.assertEqual(names(queue), ['d_b', 'd_a', 'u_a'])
+        queue = EventQueue(3, 'drop_newest')
+        for item in items: queue.put(item)
+        self.assertEqual(names(queue), ['d_a', 'd_a', 'd_b'])
+        queue = EventQueue(1, 'coalesce', keyboard._listener.repeat_key)
+        for item in items: queue.put(item)
+        self.assertEqual(names(queue), ['d_b', 'd_a', 'u_a'])
+        self.assertIs(queue.queue[1], items[3])
+        self.assertEqual(queue.stats(), {'size': 3, 'maxsize': 1, 'policy': 'coalesce', 'dropped': 2, 'high_water': 3})
+
+        with self.assertRaises(ValueError):
+            queue.configure(1, 'unknown')
+        queue.configure(0, 'block')
+        for item in items: queue.put(item)
+        self.assertEqual(queue.qsize(), 8)
+    def test_event_queue_get_all(self):
+        from ._generic import EventQueue
+        queue = EventQueue()
+        for i in range(3): queue.put(i)
+        self.assertEqual(queue.get_all(), [0, 1, 2])
+        self.assertEqual(queue.qsize(), 0)
+        queue.task_done(3)
+        queue.join()
+        with self.assertRaises(ValueError):
+            queue.task_done()
+    def test_hook_batch(self):
+        batches = []
+        def on_batch(events): batches.append(events)
+        keyboard.hook(on_batch, batch=True)
+        self.do(du_a+du_b)
+        keyboard._listener.queue.join()
+        self.assertEqual(sum(batches, []), du_a+du_b)
+        self.assertTrue(all(isinstance(batch, list) for batch in batches))
+        with self.assertRaises(ValueError):
+            keyboard.hook(on_batch, suppress=True, batch=True)
+    def test_stats(self):
+        slow = []
+        # Negative, so every call is slow even if the timer reads 0.
+        keyboard.enable_stats(-1, lambda name, duration: slow.append(name))
+        try:
+            def on_a(event): return True
+            def on_b(): pass
+            def on_c(): pass
+            keyboard.on_press_key('a', on_a, suppress=True)
+            keyboard.add_hotkey('b', on_b, suppress=True)
+            keyboard.add_hotkey('a, c', on_c)
+            self.do(du_a+du_c+du_b)
+            keyboard._listener.queue.join()
+            names = lambda: sorted(entry['name'].split('.')[-1] for entry in keyboard.stats()['handlers'])
+            handlers = dict((entry['name'].split('.')[-1], entry) for entry in keyboard.stats()['handlers'])
+            # Called for both press and release.
+            self.assertEqual(handlers['on_a']['calls'], 2)
+            self.assertEqual(handlers['on_b']['calls'], 2)
+            self.assertEqual(handlers['on_c']['calls'], 1)
+            entry = handlers['on_a']
+            self.assertEqual(sum(count for bound, count in entry['histogram']), 2)
+            self.assertEqual(len(slow), 5)
+
+            # Removed handlers are forgotten.
+            keyboard.remove_hotkey('b')
+            keyboard.remove_hotkey('a, c')
+            self.assertEqual(names(), ['on_a'])
+            keyboard.unhook_all()
+            self.assertEqual(names(), [])
+        finally:
+            keyboard.disable_stats()
+        self.assertEqual(keyboard.stats()['handlers'], [])
+    def test_blocking_budget(self):
+        calls = []
+        def slow_block(event):
+            calls.append(event)
+            time.sleep(0.01)
+            return False
+        keyboard.hook(slow_block, suppress=True)
+        keyboard.set_blocking_budget(0.001, demote_after=2)
+        self.do(du_a, du_a)
+        keyboard._listener.queue.join()
+        self.assertEqual(len(calls), 2)
+        blocking = keyboard.stats()['blocking']
+        self.assertEqual(blocking['events_over_budget'], 2)
+        self.assertEqual(len(blocking['demoted']), 1)
+        self.assertTrue(blocking['demoted'][0].endswith('slow_block'))
+
+        # Demoted, so only called from the processing thread.
+        self.do(du_b, du_b)
+        keyboard._listener.queue.join()
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(keyboard.stats()['blocking']['events_over_budget'], 2)
+
+        keyboard.set_blocking_budget(None)
+        self.assertIsNone(keyboard.stats()['blocking'])
+        self.do(du_a, [])
+    def test_blocking_budget_blame(self):
+        def slow(event):
+            time.sleep(0.03)
+            return True
+        def late(event):
+            time.sleep(0.015)
+            return True
+        keyboard.hook(slow, suppress=True)
+        keyboard.hook(late, suppress=True)
+        keyboard.set_blocking_budget(0.04, demote_after=1)
+        try:
+            self.do(d_a, d_a)
+            keyboard._listener.queue.join()
+            # `late` crossed the deadline, but `slow` took longer.
+            overruns = keyboard.stats()['blocking']['overruns']
+            self.assertEqual([name.split('.')[-1] for name in overruns], ['slow'])
+            self.assertEqual([callback.__name__ for callback in keyboard._listener.tables.demoted], ['slow'])
+        finally:
+            keyboard.set_blocking_budget(None)
+    def test_blocking_budget_modifier(self):
+        keyboard.add_hotkey('ctrl+a', lambda: None, suppress=True)
+        def slow(event):
+            time.sleep(0.01)
+            return True
+        keyboard.hook(slow, suppress=True)
+        keyboard.set_blocking_budget(0.001)
+        try:
+            # Let through when over budget, so not held and replayed later.
+            self.do(d_ctrl, d_ctrl)
+            keyboard.unhook(slow)
+            self.do(u_ctrl, u_ctrl)
+        finally:
+            keyboard.set_blocking_budget(None)
+    def test_configure_queue(self):
+        keyboard.configure_queue(100, 'drop_oldest')
+        try:
+            queue = keyboard._queue.Queue()
+            keyboard.hook(queue.put)
+            self.do(d_a+u_a)
+            self.assertEqual(queue.get(timeout=0.5).name, 'a')
+            stats = keyboard.queue_stats()
+            self.assertEqual((stats['maxsize'], stats['policy'], stats['dropped']), (100, 'drop_oldest', 0))
+        finally:
+            keyboard.configure_queue()
     def test_on_release_key(self):
         keyboard.on_release_key('a', lambda e: self.assertEqual(e.name, 'a') and self.assertEqual(e.event_type, KEY_UP))
         self.do(d_a+u_a)
@@ -436,6 +704,67 @@ class TestKeyboard(unittest.TestCase):
         keyboard.start_recording()
         self.do(d_a+u_a)
         self.assertEqual(keyboard.stop_recording(), d_a+u_a)
+    def test_start_stop_recording_batch(self):
+        keyboard.start_recording()
+        self.do(du_a+d_shift+du_b+u_shift)
+        events = keyboard.stop_recording()
+        self.assertIsInstance(events, keyboard.EventBatch)
+        self.assertEqual(len(events), 6)
+        self.assertEqual(events[-1], u_shift[0])
+        self.assertEqual(events[1:3], u_a+d_shift)
+        self.assertEqual(events[1:3][1:], d_shift)
+        self.assertEqual(events.names, ['a', 'a', 'left shift', 'b', 'b', 'left shift'])
+        self.assertEqual(list(events.scan_codes), [1, 1, 5, 2, 2, 5])
+        self.assertEqual(list(keyboard.get_typed_strings(events)), ['aB'])
+        with self.assertRaises(TypeError):
+            events[1:3].append(d_a[0])
+    def test_event_batch_pickle(self):
+        import pickle
+        events = keyboard.EventBatch(du_a+du_b)
+        self.assertEqual(pickle.loads(pickle.dumps(events)), du_a+du_b)
+    def test_event_batch_append_invalid(self):
+        events = keyboard.EventBatch(d_a)
+        with self.assertRaises(ValueError):
+            events.append(KeyboardEvent(KEY_DOWN, 0x8000, 'big', time=5))
+        with self.assertRaises(ValueError):
+            events.append(KeyboardEvent(KEY_DOWN, 1, 'a', time='later'))
+        # Nothing of the failed events was stored.
+        events.append(u_b[0])
+        self.assertEqual(list(events), d_a+u_b)
+        self.assertEqual(list(events.times), [0, 0])
+        self.assertEqual(events.names, ['a', 'b'])
+    def test_save_load_events(self):
+        import tempfile, shutil, os
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'events.bin')
+            events = du_a + [KeyboardEvent(KEY_DOWN, 999, u'á', time=5.5, device='kbd', is_keypad=True)] + u_shift
+            self.assertEqual(keyboard.save_events(path, events), 4)
+            with keyboard.load_events(path) as loaded:
+                self.assertEqual(len(loaded), 4)
+                self.assertEqual(list(loaded), events)
+                self.assertEqual(loaded[2].to_json(), events[2].to_json())
+                self.assertEqual(loaded[-1], u_shift[0])
+                keyboard.play(loaded, 0)
+                self.do([], du_a + [events[2]] + u_shift)
+        finally:
+            shutil.rmtree(directory)
+    def test_event_stream(self):
+        import io
+        from keyboard._event_file import StreamWriter, StreamReader
+        f = io.BytesIO()
+        writer = StreamWriter(f)
+        for event in du_a:
+            writer.write(event)
+        writer.flush()
+        writer.write(make_event(KEY_DOWN, u'á', 999, time=5.5))
+        writer.flush()
+        f.seek(0)
+        self.assertEqual(list(StreamReader(f)), du_a + [make_event(KEY_DOWN, u'á', 999)])
+        f.seek(0)
+        with self.assertRaises(ValueError):
+            list(StreamReader(io.BytesIO(f.read()[:-1])))
+        self.assertEqual(list(StreamReader(io.BytesIO())), [])
     def test_stop_recording_error(self):
         with self.assertRaises(ValueError):
             keyboard.stop_recording()
@@ -672,6 +1001,22 @@ class TestKeyboard(unittest.TestCase):
     def test_add_hotkey_multi_step_allow(self):
         keyboard.add_hotkey('a, b', lambda: trigger() or True, suppress=True)
         self.do(du_a+du_b, triggered_event+du_a+du_b)
+    def test_add_hotkey_multi_step_shared_prefix(self):
+        queue = keyboard._queue.Queue()
+        keyboard.add_hotkey('a, b', lambda: queue.put('b'), suppress=True)
+        keyboard.add_hotkey('a, c', lambda: queue.put('c'), suppress=True)
+        self.assertEqual(len(keyboard._listener.blocking_hotkeys[(1,)]), 1)
+        self.do(du_a+du_c, [])
+        self.assertEqual(queue.get_nowait(), 'c')
+        self.do(du_a+du_b, [])
+        self.assertEqual(queue.get_nowait(), 'b')
+        self.assertTrue(queue.empty())
+    def test_add_hotkey_multi_step_nonsuppress(self):
+        queue = keyboard._queue.Queue()
+        keyboard.add_hotkey('a, b', lambda: queue.put(True), suppress=False)
+        self.do(du_a+du_c+du_a+du_b, du_a+du_c+du_a+du_b)
+        self.assertTrue(queue.get(timeout=0.5))
+        self.assertTrue(queue.empty())
 
     def test_add_hotkey_single_step_nonsuppress(self):
         queue = keyboard._queue.Queue()
@@ -693,6 +1038,67 @@ class TestKeyboard(unittest.TestCase):
     def test_add_hotkey_single_step_suppress_regression_1(self):
         keyboard.add_hotkey('a', trigger, suppress=True)
         self.do(d_c+d_a+u_c+u_a, d_c+d_a+u_c+u_a)
+    def test_add_hotkeys(self):
+        queue = keyboard._queue.Queue()
+        keyboard._listener.start_if_necessary()
+        tables = keyboard._listener.tables
+        with self.assertRaises(ValueError):
+            keyboard.add_hotkeys([('a', trigger), ('shift+unknownkey', trigger)])
+        self.assertIs(keyboard._listener.tables, tables)
+        self.assertEqual(keyboard._hotkeys, {})
+
+        removers = keyboard.add_hotkeys({'a': lambda: queue.put('a'), 'shift+b': lambda: queue.put('b'), 'c, b': lambda: queue.put('c')}, suppress=True)
+        self.assertEqual(set(removers), set(['a', 'shift+b', 'c, b']))
+        self.do(du_a+d_shift+du_b+u_shift, [])
+        self.assertEqual(queue.get_nowait(), 'a')
+        self.assertEqual(queue.get_nowait(), 'b')
+        self.do(du_c+du_b, [])
+        self.assertEqual(queue.get_nowait(), 'c')
+
+        keyboard.remove_hotkeys(['a', removers['shift+b'], 'c, b'])
+        self.assertEqual(keyboard._hotkeys, {})
+        self.assertTrue(not any(keyboard._listener.blocking_hotkeys.values()))
+        self.assertTrue(not any(keyboard._listener.filtered_modifiers.values()))
+        with self.assertRaises(KeyError):
+            keyboard.remove_hotkeys(['a'])
+    def test_remove_hotkeys_shared_callback(self):
+        keyboard.add_hotkeys({'a': trigger, 'b': trigger, 'c': trigger}, suppress=True)
+        keyboard.remove_hotkeys(['a', 'b'])
+        self.do(du_a+du_b, du_a+du_b)
+        self.do(du_c, triggered_event)
+        keyboard.remove_hotkey('c')
+        self.assertEqual(keyboard._hotkeys, {})
+        with self.assertRaises(KeyError):
+            keyboard.remove_hotkeys(['c'])
+    def test_add_hotkeys_rollback(self):
+        keyboard._listener.start_if_necessary()
+        tables = keyboard._listener.tables
+        with self.assertRaises(ZeroDivisionError):
+            with keyboard._listener.change_tables():
+                keyboard.add_hotkey('a', trigger, suppress=True)
+                keyboard.add_hotkey('a, b', trigger, suppress=True)
+                1 / 0
+        self.assertIs(keyboard._listener.tables, tables)
+        self.assertEqual(keyboard._hotkeys, {})
+        self.do(du_a+du_b, du_a+du_b)
+    def test_add_hotkey_multi_step_lock_free(self):
+        # Registrations hold the tables lock, but hotkeys never wait for it.
+        keyboard.add_hotkey('a, b', trigger, suppress=True)
+        locked, release = threading.Event(), threading.Event()
+        def hold():
+            with keyboard._listener.tables_lock:
+                locked.set()
+                release.wait(1)
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        try:
+            start = time.time()
+            self.do(du_a+du_b, triggered_event)
+            self.assertLess(time.time() - start, 0.5)
+        finally:
+            release.set()
+            thread.join()
 
     def test_remap_hotkey_single(self):
         keyboard.remap_hotkey('a', 'b')
@@ -728,6 +1134,24 @@ class TestKeyboard(unittest.TestCase):
         self.assertEqual(keyboard.parse_hotkey_combinations('a, b'), (((1,),), ((2,),)))
     def test_parse_hotkey_combinations_multi_modifier(self):
         self.assertEqual(keyboard.parse_hotkey_combinations('shift+a, b'), (((1, 5), (1, 6)), ((2,),)))
+    def test_parse_hotkey_cache(self):
+        keyboard.parse_hotkey.cache_clear()
+        self.assertEqual(keyboard.parse_hotkey('shift+a, b'), (((5, 6), (1,)), ((2,),)))
+        self.assertEqual(keyboard.parse_hotkey('shift+a, b'), (((5, 6), (1,)), ((2,),)))
+        info = keyboard.parse_hotkey.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+        generation = getattr(keyboard._os_keyboard, 'keymap_generation', None)
+        keyboard._os_keyboard.keymap_generation = object()
+        try:
+            keyboard.parse_hotkey('shift+a, b')
+            self.assertEqual(keyboard.parse_hotkey.cache_info().misses, 2)
+        finally:
+            keyboard._os_keyboard.keymap_generation = generation
+
+        for i in range(keyboard._parse_cache.maxsize + 10):
+            keyboard.parse_hotkey('+'.join(['a'] * (i + 2)))
+        self.assertEqual(keyboard.parse_hotkey.cache_info().currsize, keyboard._parse_cache.maxsize)
     def test_parse_hotkey_combinations_list_list(self):
         self.assertEqual(keyboard.parse_hotkey_combinations(keyboard.parse_hotkey_combinations('a, b')), keyboard.parse_hotkey_combinations('a, b'))
     def test_parse_hotkey_combinations_fail_empty(self):
@@ -738,7 +1162,7 @@ class TestKeyboard(unittest.TestCase):
     def test_add_hotkey_multistep_suppress_incomplete(self):
         keyboard.add_hotkey('a, b', trigger, suppress=True)
         self.do(du_a, [])
-        self.assertEqual(keyboard._listener.blocking_hotkeys[(1,)], [])
+        self.assertEqual(keyboard._listener.blocking_hotkeys[(1,)], ())
         self.assertEqual(len(keyboard._listener.blocking_hotkeys[(2,)]), 1)
     def test_add_hotkey_multistep_suppress_incomplete(self):
         keyboard.add_hotkey('a, b', trigger, suppress=True)
@@ -755,10 +1179,23 @@ class TestKeyboard(unittest.TestCase):
     def test_add_hotkey_multistep_suppress_repeated_prefix(self):
         keyboard.add_hotkey('a, a, c', trigger, suppress=True, trigger_on_release=True)
         self.do(du_a+du_a+du_c, triggered_event)
+    def test_add_hotkey_modifier_class(self):
+        keyboard.add_hotkey('shift+ctrl+a', trigger, suppress=True)
+        self.assertEqual(len(keyboard._listener.blocking_hotkeys), 1)
+        d_right_shift = [make_event(KEY_DOWN, 'right shift')]
+        u_right_shift = [make_event(KEY_UP, 'right shift')]
+        self.do(d_ctrl+d_right_shift+d_a, triggered_event)
+        self.do(u_a+u_right_shift+u_ctrl)
+        self.do(d_ctrl+d_shift+d_a, triggered_event)
+    def test_add_hotkey_sided_modifier(self):
+        keyboard.add_hotkey('right shift+a', trigger, suppress=True)
+        self.do(d_shift+d_a, d_shift+d_a)
+        self.do(u_a+u_shift)
+        self.do([make_event(KEY_DOWN, 'right shift')]+d_a, triggered_event)
     def test_add_hotkey_multistep_suppress_repeated_key(self):
         keyboard.add_hotkey('a, b', trigger, suppress=True)
         self.do(du_a+du_a+du_b, du_a+triggered_event)
-        self.assertEqual(keyboard._listener.blocking_hotkeys[(2,)], [])
+        self.assertEqual(keyboard._listener.blocking_hotkeys[(2,)], ())
         self.assertEqual(len(keyboard._listener.blocking_hotkeys[(1,)]), 1)
     def test_add_hotkey_multi_step_suppress_regression_1(self):
         keyboard.add_hotkey('a, b', trigger, suppress=True)
@@ -818,6 +1255,218 @@ class TestKeyboard(unittest.TestCase):
         with self.assertRaises(keyboard._queue.Empty):
             queue.get(timeout=0.01)
 
+    @unittest.skipUnless(hasattr(select, 'epoll'), 'requires epoll')
+    def test_aggregated_device_listen(self):
+        from ._nixcommon import AggregatedEventDevice, EV_KEY, EV_SYN
+        first = make_pipe_device('first', [(1, 0, EV_KEY, 30, 1), (1, 0, EV_SYN, 0, 0)])
+        second = make_pipe_device('second', [(2, 500000, EV_KEY, 30, 0)])
+        received = []
+        try:
+            # Returns once both devices hang up.
+            AggregatedEventDevice([first, second]).listen(received.append)
+        finally:
+            first.input_file.close()
+            second.input_file.close()
+        self.assertEqual(sorted(received), [
+            [(1.0, EV_KEY, 30, 1, 'first'), (1.0, EV_SYN, 0, 0, 'first')],
+            [(2.5, EV_KEY, 30, 0, 'second')],
+        ])
+
+    def test_aggregated_device_listen_across_drop(self):
+        from ._nixcommon import AggregatedEventDevice, EventDevice, event_struct, EV_KEY, EV_SYN, SYN_REPORT, SYN_DROPPED
+        from threading import Thread
+        read_fd, write_fd = os.pipe()
+        device = EventDevice('kbd')
+        device._input_file = io.open(read_fd, 'rb', 0)
+        write = lambda *raw_events: os.write(write_fd, b''.join(event_struct.pack(*raw_event) for raw_event in raw_events))
+        received = []
+        thread = Thread(target=AggregatedEventDevice([device]).listen, args=(received.append,))
+        thread.daemon = True
+        try:
+            # The first read is all overflow, and returns no events.
+            write((1, 0, EV_SYN, SYN_DROPPED, 0))
+            thread.start()
+            time.sleep(0.05)
+            self.assertTrue(thread.is_alive())
+            write((1, 0, EV_SYN, SYN_REPORT, 0), (2, 0, EV_KEY, 30, 1), (2, 0, EV_SYN, SYN_REPORT, 0))
+            for _ in range(100):
+                if sum(received, []) and sum(received, [])[-1][0] == 2.0: break
+                time.sleep(0.01)
+            self.assertEqual(sum(received, []), [
+                (1.0, EV_SYN, SYN_DROPPED, 0, 'kbd'),
+                (2.0, EV_KEY, 30, 1, 'kbd'),
+                (2.0, EV_SYN, SYN_REPORT, 0, 'kbd'),
+            ])
+        finally:
+            os.close(write_fd)
+        # Returns on end of file.
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        device.input_file.close()
+
+    def test_event_device_read_events(self):
+        from ._nixcommon import EV_KEY, events_per_read
+        device = make_pipe_device('kbd', [(1, 250000, EV_KEY, code, 1) for code in range(events_per_read + 3)])
+        try:
+            first = device.read_events()
+            self.assertEqual(len(first), events_per_read)
+            self.assertEqual(first[0], (1.25, EV_KEY, 0, 1, 'kbd'))
+            self.assertEqual([event[2] for event in device.read_events()], list(range(events_per_read, events_per_read + 3)))
+            self.assertIsNone(device.read_events())
+        finally:
+            device.input_file.close()
+
+    def test_event_device_skip_dropped(self):
+        from ._nixcommon import EventDevice, EV_KEY, EV_SYN, SYN_REPORT, SYN_DROPPED
+        device = EventDevice('kbd')
+        key = lambda code: (1.0, EV_KEY, code, 1, 'kbd')
+        syn = lambda code: (1.0, EV_SYN, code, 0, 'kbd')
+        self.assertEqual(device._skip_dropped([key(1), syn(SYN_DROPPED), key(2)]), [key(1)])
+        # Incomplete until the next report, even across reads.
+        self.assertEqual(device._skip_dropped([key(3)]), [])
+        self.assertEqual(device._skip_dropped([key(4), syn(SYN_REPORT), key(5)]), [syn(SYN_DROPPED), key(5)])
+        self.assertEqual(device._skip_dropped([key(6), syn(SYN_REPORT)]), [key(6), syn(SYN_REPORT)])
+        self.assertEqual(device.drop_count, 1)
+    def test_os_drop_count(self):
+        get_drop_count = getattr(keyboard._os_keyboard, 'get_drop_count', None)
+        keyboard._os_keyboard.get_drop_count = lambda: 3
+        try:
+            self.assertEqual(keyboard.os_drop_count(), 3)
+            self.assertEqual(keyboard.stats()['os_drops'], 3)
+            del keyboard._os_keyboard.get_drop_count
+            self.assertIsNone(keyboard.os_drop_count())
+        finally:
+            if get_drop_count is not None:
+                keyboard._os_keyboard.get_drop_count = get_drop_count
+
+    def test_linux_tables_cache(self):
+        import tempfile, shutil
+        from . import _nixkeyboard
+        tables = (_nixkeyboard.to_name, _nixkeyboard.from_name, _nixkeyboard.keypad_scan_codes)
+        # Names without entries are left out of the cache.
+        contents = lambda: [dict((key, value) for key, value in table.items() if value) for table in tables[:2]] + [set(tables[2])]
+        saved = [table.copy() for table in tables] + [_nixkeyboard.tables_cache_path]
+        directory = tempfile.mkdtemp()
+        try:
+            for table in tables: table.clear()
+            _nixkeyboard.tables_cache_path = os.path.join(directory, 'keyboard', 'tables.json')
+            # 'a', 'A' with shift and keypad 1.
+            keymap = [(0, 30, 0x0b61), (1, 30, 0x0b41), (0, 79, 0x0301)]
+            fingerprint = _nixkeyboard.get_keymap_fingerprint(keymap)
+            self.assertNotEqual(fingerprint, _nixkeyboard.get_keymap_fingerprint(keymap[:2]))
+            _nixkeyboard.build_tables_from_keymap(keymap)
+            expected = contents()
+            _nixkeyboard.save_tables_cache(fingerprint)
+            self.assertEqual(os.listdir(os.path.dirname(_nixkeyboard.tables_cache_path)), ['tables.json'])
+
+            for table in tables: table.clear()
+            self.assertFalse(_nixkeyboard.load_tables_cache('stale'))
+            self.assertTrue(_nixkeyboard.load_tables_cache(fingerprint))
+            self.assertEqual(contents(), expected)
+            self.assertEqual(_nixkeyboard.to_name[(30, ('shift',))], ['A'])
+            self.assertIn(79, _nixkeyboard.keypad_scan_codes)
+
+            # Failed writes leave no temporary file behind.
+            os.remove(_nixkeyboard.tables_cache_path)
+            os.mkdir(_nixkeyboard.tables_cache_path)
+            _nixkeyboard.save_tables_cache(fingerprint)
+            self.assertEqual(os.listdir(os.path.dirname(_nixkeyboard.tables_cache_path)), ['tables.json'])
+        finally:
+            shutil.rmtree(directory)
+            for table, copy in zip(tables, saved):
+                table.clear()
+                table.update(copy)
+            _nixkeyboard.tables_cache_path = saved[-1]
+
+    def test_linux_keysym_name(self):
+        from ._nixkeyboard import keysym_name
+        self.assertEqual(keysym_name(0x0061), 'a')
+        self.assertEqual(keysym_name(0x0b41), 'A')
+        self.assertEqual(keysym_name(0x0b2b), 'plus')
+        self.assertEqual(keysym_name(0x001b), 'Escape')
+        self.assertEqual(keysym_name(0x007f), 'Delete')
+        self.assertEqual(keysym_name(0x0861), 'Meta_a')
+        self.assertEqual(keysym_name(0x0100), 'F1')
+        self.assertEqual(keysym_name(0x0115), 'Insert')
+        self.assertEqual(keysym_name(0x0301), 'KP_1')
+        self.assertEqual(keysym_name(0x0702), 'Control')
+        # Unicode keymaps.
+        self.assertEqual(keysym_name(0xf000 ^ 0xe9), u'\xe9')
+        # C1 control characters and unknown types have no name.
+        self.assertIsNone(keysym_name(0x0085))
+        self.assertIsNone(keysym_name(0x0885))
+        self.assertIsNone(keysym_name(0x0e00))
+        self.assertIsNone(keysym_name(0x0614))
+
+    def test_linux_name_lookup(self):
+        from . import _nixkeyboard
+        saved = dict(_nixkeyboard.to_name), list(_nixkeyboard.names_by_index), list(_nixkeyboard.modifier_bit_by_index)
+        try:
+            _nixkeyboard.to_name.clear()
+            _nixkeyboard.to_name.update({
+                (30, ()): ['a'],
+                (30, ('shift',)): ['A'],
+                (42, ()): ['shift'],
+                (125, ()): ['windows'],
+            })
+            _nixkeyboard.build_name_lookup()
+            shift, windows = _nixkeyboard.modifier_bits['shift'], _nixkeyboard.modifier_bits['windows']
+            name = lambda scan_code, mask: _nixkeyboard.names_by_index[_nixkeyboard.get_name_index(scan_code, mask)]
+            self.assertEqual(name(30, 0), 'a')
+            self.assertEqual(name(30, shift), 'A')
+            # Planes without a name, and masks with modifiers that don't
+            # select a plane, fall back to the base name.
+            self.assertEqual(name(30, _nixkeyboard.modifier_bits['ctrl']), 'a')
+            self.assertEqual(name(30, shift | windows), 'a')
+            self.assertEqual(name(31, 0), 'unknown')
+            self.assertIsNone(_nixkeyboard.get_name_index(_nixkeyboard.KEY_CNT, 0))
+            self.assertIsNone(_nixkeyboard.get_name_index(-1, 0))
+
+            bit = lambda scan_code: _nixkeyboard.modifier_bit_by_index[_nixkeyboard.get_name_index(scan_code, 0)]
+            self.assertEqual((bit(42), bit(125), bit(30)), (shift, windows, 0))
+            self.assertEqual(_nixkeyboard.get_modifiers_tuple(shift | windows), ('shift', 'windows'))
+            self.assertEqual(_nixkeyboard.get_modifiers_tuple(0), ())
+        finally:
+            _nixkeyboard.to_name.clear()
+            _nixkeyboard.to_name.update(saved[0])
+            _nixkeyboard.names_by_index[:] = saved[1]
+            _nixkeyboard.modifier_bit_by_index[:] = saved[2]
+
+    def test_linux_resync(self):
+        from . import _nixkeyboard
+        from ._nixcommon import EV_KEY, EV_SYN, SYN_REPORT, SYN_DROPPED
+        class FakeDevice(object):
+            def get_device(self, path):
+                return self
+            def get_pressed_keys(self):
+                # Read after the whole batch, so includes the key press.
+                return set([30])
+            def listen(self, callback):
+                callback([(1.0, EV_SYN, SYN_DROPPED, 0, 'kbd'), (1.0, EV_KEY, 30, 1, 'kbd'), (1.0, EV_SYN, SYN_REPORT, 0, 'kbd')])
+                callback([(2.0, EV_KEY, 30, 0, 'kbd')])
+        saved = dict(_nixkeyboard.to_name), dict(_nixkeyboard.from_name), list(_nixkeyboard.names_by_index), list(_nixkeyboard.modifier_bit_by_index), _nixkeyboard.device
+        try:
+            _nixkeyboard.to_name.clear()
+            _nixkeyboard.to_name[(30, ())] = ['a']
+            _nixkeyboard.from_name['a'] = [(30, ())]
+            _nixkeyboard.build_name_lookup()
+            _nixkeyboard.device = FakeDevice()
+            _nixkeyboard.pressed_keys.clear()
+            events = []
+            self.assertIs(os_listen.__module__, _nixkeyboard.__name__)
+            os_listen(events.append)
+            self.assertEqual([(event.event_type, event.name, event.time) for event in events], [(KEY_DOWN, 'a', events[0].time), (KEY_UP, 'a', 2.0)])
+            self.assertEqual(_nixkeyboard.pressed_keys['kbd'], set())
+        finally:
+            _nixkeyboard.to_name.clear()
+            _nixkeyboard.to_name.update(saved[0])
+            _nixkeyboard.from_name.clear()
+            _nixkeyboard.from_name.update(saved[1])
+            _nixkeyboard.names_by_index[:] = saved[2]
+            _nixkeyboard.modifier_bit_by_index[:] = saved[3]
+            _nixkeyboard.device = saved[4]
+            _nixkeyboard.pressed_keys.clear()
+
     #def test_add_abbreviation(self):
     #    keyboard.add_abbreviation('abc', 'aaa')
     #    self.do(du_a+du_b+du_c+du_space, [])
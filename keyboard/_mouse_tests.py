@@ -95,6 +95,14 @@ class TestMouse(unittest.TestCase):
         self.press()
         self.assertEqual(len(events), 1)
 
+    def test_queue_coalesce(self):
+        from ._generic import EventQueue
+        queue = EventQueue(1, 'coalesce', mouse._listener.repeat_key)
+        events = [MoveEvent(1, 1, 0), MoveEvent(2, 2, 1), ButtonEvent(DOWN, LEFT, 2), MoveEvent(3, 3, 3), MoveEvent(4, 4, 4)]
+        for event in events: queue.put(event)
+        self.assertEqual(list(queue.queue), [events[1], events[2], events[4]])
+        self.assertEqual(queue.dropped, 2)
+
     def test_is_pressed(self):
         self.assertFalse(mouse.is_pressed())
         self.press()
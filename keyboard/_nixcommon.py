@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 import struct
 import os
+import io
 import atexit
+import errno
+import select
+import ctypes
 from time import time as now
 from threading import Thread
 from glob import glob
@@ -11,6 +15,16 @@ except ImportError:
     from Queue import Queue
 
 event_bin_format = 'llHHI'
+event_struct = struct.Struct(event_bin_format)
+# Upper bound of events pulled from a device by a single `read` syscall.
+events_per_read = 64
+
+if hasattr(event_struct, 'iter_unpack'):
+    unpack_events = event_struct.iter_unpack
+else:
+    # Python 2.
+    def unpack_events(data):
+        return (event_struct.unpack_from(data, i) for i in range(0, len(data), event_struct.size))
 
 # Taken from include/linux/input.h
 # https://www.kernel.org/doc/Documentation/input/event-codes.txt
@@ -20,6 +34,43 @@ EV_REL = 0x02
 EV_ABS = 0x03
 EV_MSC = 0x04
 
+SYN_REPORT = 0x00
+SYN_DROPPED = 0x03
+
+# Number of codes per event type, used to size bitmaps.
+EV_CNT = 0x20
+code_counts = {
+    EV_SYN: EV_CNT, # The EV_SYN bitmap lists event types, not codes.
+    EV_KEY: 0x300,
+    EV_REL: 0x10,
+    EV_ABS: 0x40,
+    EV_MSC: 0x08,
+}
+
+# ioctl requests from include/uapi/linux/input.h.
+def _input_ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord('E') << 8) | number
+_IOC_WRITE = 1
+_IOC_READ = 2
+def EVIOCGBIT(type, length):
+    return _input_ioc(_IOC_READ, 0x20 + type, length)
+def EVIOCGKEY(length):
+    return _input_ioc(_IOC_READ, 0x18, length)
+# struct input_mask { __u32 type; __u32 codes_size; __u64 codes_ptr; }
+input_mask_format = 'IIQ'
+EVIOCSMASK = _input_ioc(_IOC_WRITE, 0x93, struct.calcsize(input_mask_format))
+
+# Kernel bitmaps are arrays of native `unsigned long`.
+_long_bits = ctypes.sizeof(ctypes.c_ulong) * 8
+def make_bitmap(count, bits=()):
+    bitmap = (ctypes.c_ulong * ((count + _long_bits - 1) // _long_bits))()
+    for bit in bits:
+        bitmap[bit // _long_bits] |= 1 << (bit % _long_bits)
+    return bitmap
+
+def bitmap_to_set(bitmap):
+    return set(i * _long_bits + j for i, word in enumerate(bitmap) if word for j in range(_long_bits) if word >> j & 1)
+
 def make_uinput():
     if not os.path.exists('/dev/uinput'):
         raise IOError('No uinput module found.')
@@ -53,12 +104,23 @@ class EventDevice(object):
         self.path = path
         self._input_file = None
         self._output_file = None
+        self._read_buffer = bytearray(event_struct.size * events_per_read)
+        self._read_view = memoryview(self._read_buffer)
+        # {type: codes} applied after each read when the kernel can't do it.
+        self._event_filter = None
+        # Number of times the kernel buffer overflowed and events were lost.
+        self.drop_count = 0
+        self._dropping = False
 
     @property
     def input_file(self):
         if self._input_file is None:
             try:
-                self._input_file = open(self.path, 'rb')
+                # Unbuffered, so each read is a single syscall and no events
+                # are left hidden in a userspace buffer while `epoll` waits.
+                # `io.open` because Python 2 files retry short reads until
+                # the buffer is full.
+                self._input_file = io.open(self.path, 'rb', 0)
             except IOError as e:
                 if e.strerror == 'Permission denied':
                     print('Permission denied ({}). You must be sudo to access global events.'.format(self.path))
@@ -80,10 +142,117 @@ class EventDevice(object):
         return self._output_file
 
     def read_event(self):
-        data = self.input_file.read(struct.calcsize(event_bin_format))
-        seconds, microseconds, type, code, value = struct.unpack(event_bin_format, data)
+        data = self.input_file.read(event_struct.size)
+        seconds, microseconds, type, code, value = event_struct.unpack(data)
         return seconds + microseconds / 1e6, type, code, value, self.path
 
+    def read_events(self):
+        """
+        Blocks until events are available, then returns a list with all of
+        them (up to `events_per_read`). The kernel only hands out whole
+        events, so a single `read` into the reusable buffer is enough.
+
+        The list may be empty when all events read were filtered out or part
+        of an overflow, so end of file is returned as None instead.
+        """
+        length = self.input_file.readinto(self._read_buffer)
+        if not length:
+            return None
+        path = self.path
+        events = [(seconds + microseconds / 1e6, type, code, value, path)
+                  for seconds, microseconds, type, code, value in unpack_events(self._read_view[:length])]
+        if self._dropping or any(event[1] == EV_SYN and event[2] == SYN_DROPPED for event in events):
+            events = self._skip_dropped(events)
+        if self._event_filter is not None:
+            event_filter = self._event_filter
+            events = [event for event in events if event[1] == EV_SYN or (
+                event[1] in event_filter and (event_filter[event[1]] is None or event[2] in event_filter[event[1]])
+            )]
+        return events
+
+    def _skip_dropped(self, events):
+        """
+        After a SYN_DROPPED the events up to the next SYN_REPORT are
+        incomplete. Replaces that stretch with a single SYN_DROPPED event,
+        delivered once the device is consistent again, so listeners know when
+        to resync their state (e.g. with `get_pressed_keys`).
+        """
+        kept = []
+        for event in events:
+            type, code = event[1], event[2]
+            if type == EV_SYN and code == SYN_DROPPED:
+                self.drop_count += 1
+                self._dropping = True
+            elif not self._dropping:
+                kept.append(event)
+            elif type == EV_SYN and code == SYN_REPORT:
+                self._dropping = False
+                kept.append(event[:2] + (SYN_DROPPED,) + event[3:])
+        return kept
+
+    def get_pressed_keys(self):
+        """ Returns the set of key codes currently held down on this device. """
+        import fcntl
+        bitmap = make_bitmap(code_counts[EV_KEY])
+        fcntl.ioctl(self.input_file, EVIOCGKEY(ctypes.sizeof(bitmap)), bitmap, True)
+        return bitmap_to_set(bitmap)
+
+    def get_bits(self, type):
+        """
+        Returns the set of codes of the given event type supported by this
+        device, or the set of supported event types if `type` is EV_SYN.
+        """
+        import fcntl
+        bitmap = make_bitmap(code_counts[type])
+        fcntl.ioctl(self.input_file, EVIOCGBIT(type, ctypes.sizeof(bitmap)), bitmap, True)
+        return bitmap_to_set(bitmap)
+
+    def set_event_mask(self, event_mask):
+        """
+        Restricts the events delivered by this device to the types and codes
+        in `event_mask` (`{type: codes}`, where `codes=None` allows all codes
+        of that type). EV_SYN events are always delivered.
+
+        The filtering is done by the kernel with EVIOCSMASK, so unwanted events
+        never reach Python. Kernels older than 4.4 don't support it, in which
+        case the same filter is applied after each read.
+
+        Returns False if the device can't produce any of the requested
+        events, True otherwise.
+        """
+        import fcntl
+        try:
+            supported_types = self.get_bits(EV_SYN)
+        except (IOError, OSError):
+            supported_types = None
+        if supported_types is not None and not supported_types & (set(event_mask) - set([EV_SYN])):
+            return False
+
+        masks = [(EV_SYN, make_bitmap(code_counts[EV_SYN], event_mask))]
+        for type, codes in event_mask.items():
+            if codes is not None:
+                masks.append((type, make_bitmap(code_counts[type], codes)))
+        try:
+            for type, bitmap in masks:
+                input_mask = struct.pack(input_mask_format, type, ctypes.sizeof(bitmap), ctypes.addressof(bitmap))
+                fcntl.ioctl(self.input_file, EVIOCSMASK, input_mask)
+            self._event_filter = None
+        except (IOError, OSError):
+            self._event_filter = dict((type, None if codes is None else frozenset(codes)) for type, codes in event_mask.items())
+        return True
+
+    def listen(self, callback):
+        """
+        Blocks until the device hangs up, invoking `callback` with each
+        non-empty list of events read from it.
+        """
+        while True:
+            events = self.read_events()
+            if events is None:
+                return
+            if events:
+                callback(events)
+
     def write_event(self, type, code, value):
         integer, fraction = divmod(now(), 1)
         seconds = int(integer)
@@ -98,18 +267,87 @@ class EventDevice(object):
 
 class AggregatedEventDevice(object):
     def __init__(self, devices, output=None):
-        self.event_queue = Queue()
+        self.event_queue = None
         self.devices = devices
         self.output = output or self.devices[0]
-        def start_reading(device):
-            while True:
-                self.event_queue.put(device.read_event())
+
+    def listen(self, callback):
+        """
+        Blocks forever, invoking `callback` with each list of events read from
+        any of the aggregated devices. A single `epoll` object waits on all
+        device files at once, so events are dispatched from the calling
+        thread without any intermediate queue.
+        """
+        poll = select.epoll()
+        devices_by_fd = {}
         for device in self.devices:
-            thread = Thread(target=start_reading, args=[device])
-            thread.setDaemon(True)
-            thread.start()
+            fd = device.input_file.fileno()
+            devices_by_fd[fd] = device
+            poll.register(fd, select.EPOLLIN)
+
+        while devices_by_fd:
+            try:
+                ready = poll.poll()
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            for fd, poll_events in ready:
+                device = devices_by_fd[fd]
+                if poll_events & select.EPOLLIN:
+                    try:
+                        events = device.read_events()
+                    except (IOError, OSError) as e:
+                        if e.errno in (errno.EINTR, errno.EAGAIN):
+                            continue
+                        # ENODEV when the device was unplugged.
+                        if e.errno != errno.ENODEV:
+                            raise
+                        events = None
+                    if events is not None:
+                        if events:
+                            callback(events)
+                        continue
+                elif not poll_events & (select.EPOLLHUP | select.EPOLLERR):
+                    continue
+                # Device is gone, stop waiting on it.
+                poll.unregister(fd)
+                del devices_by_fd[fd]
+
+    def set_event_mask(self, event_mask):
+        """
+        Restricts the events delivered by all aggregated devices (see
+        `EventDevice.set_event_mask`). Devices that can't produce any of the
+        requested events, like the "PC Speaker" listed as a keyboard, are no
+        longer read.
+        """
+        self.devices = [device for device in self.devices if device.set_event_mask(event_mask)]
+
+    @property
+    def drop_count(self):
+        """ Total number of buffer overflows reported by the aggregated devices. """
+        return sum(device.drop_count for device in self.devices)
+
+    def get_device(self, path):
+        for device in self.devices:
+            if device.path == path:
+                return device
 
     def read_event(self):
+        """
+        Blocks until an event is available from any of the aggregated devices
+        and returns it. Kept for compatibility, prefer `listen`, which avoids
+        the background thread and queue.
+        """
+        if self.event_queue is None:
+            self.event_queue = Queue()
+            def enqueue(events):
+                for event in events:
+                    self.event_queue.put(event)
+            thread = Thread(target=self.listen, args=[enqueue])
+            thread.daemon = True
+            thread.start()
         return self.event_queue.get(block=True)
 
     def write_event(self, type, code, value):
@@ -1,14 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
 import struct
 import traceback
 from time import time as now
 from collections import namedtuple
 from ._keyboard_event import KeyboardEvent, KEY_DOWN, KEY_UP
 from ._canonical_names import all_modifiers, normalize_name
-from ._nixcommon import EV_KEY, aggregate_devices, ensure_root
-
-# TODO: start by reading current keyboard state, as to not missing any already pressed keys.
-# See: http://stackoverflow.com/questions/3649874/how-to-get-keyboard-state-in-linux
+from ._nixcommon import EV_KEY, EV_SYN, SYN_DROPPED, aggregate_devices, ensure_root
 
 def cleanup_key(name):
     """ Formats a dumpkeys format to our standard. """
@@ -52,6 +50,9 @@ import re
 to_name = defaultdict(list)
 from_name = defaultdict(list)
 keypad_scan_codes = set()
+# Incremented every time the tables are built, so anything derived from them
+# (like parsed hotkeys) can be invalidated.
+keymap_generation = 0
 
 def register_key(key_and_modifiers, name):
     if name not in to_name[key_and_modifiers]:
@@ -59,28 +60,22 @@ def register_key(key_and_modifiers, name):
     if key_and_modifiers not in from_name[name]:
         from_name[name].append(key_and_modifiers)
 
-def build_tables():
-    if to_name and from_name: return
-    ensure_root()
-
-    modifiers_bits = {
-        'shift': 1,
-        'alt gr': 2,
-        'ctrl': 4,
-        'alt': 8,
-    }
-    keycode_template = r'^keycode\s+(\d+)\s+=(.*?)$'
-    dump = check_output(['dumpkeys', '--keys-only'], universal_newlines=True)
-    for str_scan_code, str_names in re.findall(keycode_template, dump, re.MULTILINE):
-        scan_code = int(str_scan_code)
-        for i, str_name in enumerate(str_names.strip().split()):
-            modifiers = tuple(sorted(modifier for modifier, bit in modifiers_bits.items() if i & bit))
-            name, is_keypad = cleanup_key(str_name)
-            register_key((scan_code, modifiers), name)
-            if is_keypad:
-                keypad_scan_codes.add(scan_code)
-                register_key((scan_code, modifiers), 'keypad ' + name)
-
+modifiers_bits = {
+    'shift': 1,
+    'alt gr': 2,
+    'ctrl': 4,
+    'alt': 8,
+}
+
+def register_names(scan_code, plane, str_name):
+    modifiers = tuple(sorted(modifier for modifier, bit in modifiers_bits.items() if plane & bit))
+    name, is_keypad = cleanup_key(str_name)
+    register_key((scan_code, modifiers), name)
+    if is_keypad:
+        keypad_scan_codes.add(scan_code)
+        register_key((scan_code, modifiers), 'keypad ' + name)
+
+def register_missing_keys():
     # dumpkeys consistently misreports the Windows key, sometimes
     # skipping it completely or reporting as 'alt. 125 = left win,
     # 126 = right win.
@@ -93,52 +88,435 @@ def build_tables():
     if (127, ()) not in to_name:
         register_key((127, ()), 'menu')
 
-    synonyms_template = r'^(\S+)\s+for (.+)$'
-    dump = check_output(['dumpkeys', '--long-info'], universal_newlines=True)
-    for synonym_str, original_str in re.findall(synonyms_template, dump, re.MULTILINE):
+def register_synonyms(synonyms):
+    for synonym_str, original_str in synonyms:
         synonym, _ = cleanup_key(synonym_str)
         original, _ = cleanup_key(original_str)
         if synonym != original:
             from_name[original].extend(from_name[synonym])
             from_name[synonym].extend(from_name[original])
 
+def build_tables():
+    if to_name and from_name: return
+    ensure_root()
+
+    try:
+        keymap = read_kernel_keymap()
+    except (IOError, OSError):
+        keymap = None
+
+    if keymap is None:
+        build_tables_from_dumpkeys()
+    else:
+        fingerprint = get_keymap_fingerprint(keymap)
+        if not load_tables_cache(fingerprint):
+            build_tables_from_keymap(keymap)
+            save_tables_cache(fingerprint)
+    build_name_lookup()
+    global keymap_generation
+    keymap_generation += 1
+
+def build_tables_from_dumpkeys():
+    keycode_template = r'^keycode\s+(\d+)\s+=(.*?)$'
+    dump = check_output(['dumpkeys', '--keys-only'], universal_newlines=True)
+    for str_scan_code, str_names in re.findall(keycode_template, dump, re.MULTILINE):
+        scan_code = int(str_scan_code)
+        for i, str_name in enumerate(str_names.strip().split()):
+            register_names(scan_code, i, str_name)
+
+    register_missing_keys()
+
+    synonyms_template = r'^(\S+)\s+for (.+)$'
+    dump = check_output(['dumpkeys', '--long-info'], universal_newlines=True)
+    register_synonyms(re.findall(synonyms_template, dump, re.MULTILINE))
+
+"""
+The same tables can be built without `dumpkeys` (which is not always
+installed) by asking the kernel for the keysym of every scan code and
+modifier plane with the KDGKBENT ioctl on a virtual console. Keysyms are
+converted to the names `dumpkeys` would print, using the tables from kbd's
+`ksyms.c`, so the rest of the processing is shared.
+"""
+KDGKBTYPE = 0x4B33
+KDGKBENT = 0x4B46
+kbentry_format = 'BBH' # struct kbentry { u8 kb_table; u8 kb_index; u16 kb_value; }
+NR_KEYS = 256
+NR_TYPES = 15
+K_HOLE = 0x0200
+K_NOSUCHMAP = 0x027f
+
+latin_control_names = [
+    'nul', 'Control_a', 'Control_b', 'Control_c', 'Control_d', 'Control_e', 'Control_f', 'Control_g',
+    'BackSpace', 'Tab', 'Linefeed', 'Control_k', 'Control_l', 'Control_m', 'Control_n', 'Control_o',
+    'Control_p', 'Control_q', 'Control_r', 'Control_s', 'Control_t', 'Control_u', 'Control_v', 'Control_w',
+    'Control_x', 'Control_y', 'Control_z', 'Escape', 'Control_backslash', 'Control_bracketright', 'Control_asciicircum', 'Control_underscore',
+]
+try:
+    _unichr = unichr
+except NameError:
+    _unichr = chr
+def latin_name(value):
+    if value < 0x20:
+        return latin_control_names[value]
+    elif value == 0x7f:
+        return 'Delete'
+    elif 0x80 <= value < 0xa0:
+        return None
+    return printable_name(_unichr(value))
+
+def printable_name(character):
+    # A leading "+" is stripped by `cleanup_key`, as `dumpkeys` uses it to
+    # mark letters affected by caps lock.
+    return 'plus' if character == '+' else character
+
+keysym_names_by_type = {
+    1: ['F{}'.format(i + 1) for i in range(20)] + ['Find', 'Insert', 'Remove', 'Select', 'Prior', 'Next', 'Macro', 'Help', 'Do', 'Pause'] + ['F{}'.format(i) for i in range(21, 247)],
+    2: ['VoidSymbol', 'Return', 'Show_Registers', 'Show_Memory', 'Show_State', 'Break', 'Last_Console', 'Caps_Lock', 'Num_Lock', 'Scroll_Lock', 'Scroll_Forward', 'Scroll_Backward', 'Boot', 'Caps_On', 'Compose', 'SAK', 'Decr_Console', 'Incr_Console', 'KeyboardSignal', 'Bare_Num_Lock'],
+    3: ['KP_{}'.format(i) for i in range(10)] + ['KP_Add', 'KP_Subtract', 'KP_Multiply', 'KP_Divide', 'KP_Enter', 'KP_Comma', 'KP_Period', 'KP_MinPlus'],
+    4: ['dead_grave', 'dead_acute', 'dead_circumflex', 'dead_tilde', 'dead_diaeresis', 'dead_cedilla'],
+    5: ['Console_{}'.format(i + 1) for i in range(63)],
+    6: ['Down', 'Left', 'Right', 'Up'],
+    7: ['Shift', 'AltGr', 'Control', 'Alt', 'ShiftL', 'ShiftR', 'CtrlL', 'CtrlR', 'CapsShift'],
+    9: ['Ascii_{}'.format(i) for i in range(10)] + ['Hex_{}'.format(c) for c in '0123456789ABCDEF'],
+    10: ['Shift_Lock', 'AltGr_Lock', 'Control_Lock', 'Alt_Lock', 'ShiftL_Lock', 'ShiftR_Lock', 'CtrlL_Lock', 'CtrlR_Lock', 'CapsShift_Lock'],
+    12: ['SShift', 'SAltGr', 'SControl', 'SAlt', 'SShiftL', 'SShiftR', 'SCtrlL', 'SCtrlR', 'SCapsShift'],
+}
+
+# Same list `dumpkeys --long-info` prints, from kbd's `ksyms.c`.
+kernel_keymap_synonyms = [
+    ('Control_h', 'BackSpace'), ('Control_i', 'Tab'), ('Control_j', 'Linefeed'),
+    ('Home', 'Find'), ('End', 'Select'), ('PageUp', 'Prior'), ('PageDown', 'Next'),
+    ('multiplication', 'multiply'), ('pound', 'sterling'), ('pilcrow', 'paragraph'), ('Oslash', 'Ooblique'),
+    ('Shift_L', 'ShiftL'), ('Shift_R', 'ShiftR'), ('Control_L', 'CtrlL'), ('Control_R', 'CtrlR'),
+    ('AltL', 'Alt'), ('AltR', 'AltGr'), ('Alt_L', 'Alt'), ('Alt_R', 'AltGr'), ('AltGr_L', 'Alt'), ('AltGr_R', 'AltGr'),
+    ('AltLLock', 'Alt_Lock'), ('AltRLock', 'AltGr_Lock'), ('SCtrl', 'SControl'),
+    ('Spawn_Console', 'KeyboardSignal'), ('Uncaps_Shift', 'CapsShift'),
+    ('lambda', 'lamda'), ('Lambda', 'Lamda'), ('xi', 'ksi'), ('Xi', 'Ksi'), ('chi', 'khi'), ('Chi', 'Khi'),
+    ('tilde', 'asciitilde'), ('circumflex', 'asciicircum'),
+    ('dead_ogonek', 'dead_cedilla'), ('dead_caron', 'dead_circumflex'), ('dead_breve', 'dead_tilde'), ('dead_doubleacute', 'dead_tilde'),
+    ('Idotabove', 'Iabovedot'), ('dotlessi', 'idotless'),
+    ('no-break_space', 'nobreakspace'), ('paragraph_sign', 'section'), ('soft_hyphen', 'hyphen'),
+    ('rightanglequote', 'guillemotright'),
+]
+
+def keysym_name(value):
+    """ Converts a kernel keysym to the name `dumpkeys` would use for it. """
+    type, index = value >> 8, value & 0xff
+    if type >= NR_TYPES:
+        # Unicode keymaps store code points xor'ed with 0xf000.
+        return printable_name(_unichr(value ^ 0xf000))
+    elif type == 0 or type == 11: # KT_LATIN, KT_LETTER
+        return latin_name(index)
+    elif type == 8: # KT_META
+        name = latin_name(index)
+        return name and 'Meta_' + name
+    names = keysym_names_by_type.get(type, ())
+    return names[index] if index < len(names) else None
+
+def open_console():
+    """ Returns a file descriptor for a console that accepts keyboard ioctls. """
+    import fcntl
+    for path in ('/dev/tty0', '/dev/console', '/dev/tty'):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOCTTY)
+        except (IOError, OSError):
+            continue
+        try:
+            fcntl.ioctl(fd, KDGKBTYPE, bytearray(1), True)
+            return fd
+        except (IOError, OSError):
+            os.close(fd)
+    raise IOError('No console found to read the keymap from.')
+
+def read_kernel_keymap():
+    """
+    Returns the keysym of every scan code in each modifier plane as a list of
+    `(plane, scan_code, keysym)`, skipping holes.
+    """
+    import fcntl
+    fd = open_console()
+    try:
+        entry = bytearray(struct.calcsize(kbentry_format))
+        def get_keysym(plane, scan_code):
+            struct.pack_into(kbentry_format, entry, 0, plane, scan_code, 0)
+            fcntl.ioctl(fd, KDGKBENT, entry, True)
+            return struct.unpack(kbentry_format, bytes(entry))[2]
+
+        keymap = []
+        for plane in range(max(modifiers_bits.values()) * 2):
+            if get_keysym(plane, 0) == K_NOSUCHMAP:
+                continue
+            for scan_code in range(NR_KEYS):
+                value = get_keysym(plane, scan_code)
+                if value != K_HOLE and value != K_NOSUCHMAP:
+                    keymap.append((plane, scan_code, value))
+        return keymap
+    finally:
+        os.close(fd)
+
+def build_tables_from_keymap(keymap):
+    """ Fills the name tables from the output of `read_kernel_keymap`. """
+    for plane, scan_code, value in keymap:
+        str_name = keysym_name(value)
+        if str_name:
+            register_names(scan_code, plane, str_name)
+
+    register_missing_keys()
+    register_synonyms(kernel_keymap_synonyms)
+
+"""
+Converting the keysyms to names takes much longer than reading them, so the
+tables are cached on disk, keyed by a fingerprint of the keysyms themselves.
+A keymap changed at runtime with `loadkeys` is then noticed the next time the
+tables are built. When the keymap can only be read through `dumpkeys`, the
+tables are not cached.
+
+The cache is only written to or read from directories owned by the
+effective user, so running under `sudo` with the invoking user's `HOME`
+neither leaves root-owned files there nor trusts files that user could have
+changed.
+"""
+import json
+import hashlib
+
+tables_cache_version = 2
+tables_cache_path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'keyboard', 'linux_tables.json')
+
+def get_keymap_fingerprint(keymap):
+    data = json.dumps([tables_cache_version, keymap], separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def is_owned(path):
+    """ True if `path` is owned by the effective user. """
+    try:
+        return os.stat(path).st_uid == os.geteuid()
+    except (IOError, OSError):
+        return False
+
+def is_private(path):
+    """ True if `path` is owned by the effective user and only writable by it. """
+    try:
+        info = os.stat(path)
+    except (IOError, OSError):
+        return False
+    return info.st_uid == os.geteuid() and not info.st_mode & 0o022
+
+def load_tables_cache(fingerprint):
+    """
+    Fills the name tables from the cache file if it matches the given
+    fingerprint. Returns False if the cache is missing, stale, unreadable or
+    could have been written by another user.
+    """
+    if not is_private(os.path.dirname(tables_cache_path)) or not is_private(tables_cache_path):
+        return False
+    try:
+        with open(tables_cache_path) as f:
+            cache = json.load(f)
+        if cache['fingerprint'] != fingerprint:
+            return False
+        for scan_code, modifiers, names in cache['to_name']:
+            to_name[(scan_code, tuple(modifiers))] = names
+        for name, entries in cache['from_name']:
+            from_name[name] = [(scan_code, tuple(modifiers)) for scan_code, modifiers in entries]
+        keypad_scan_codes.update(cache['keypad_scan_codes'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        to_name.clear()
+        from_name.clear()
+        keypad_scan_codes.clear()
+        return False
+    return True
+
+def save_tables_cache(fingerprint):
+    cache = {
+        'fingerprint': fingerprint,
+        'to_name': [[scan_code, modifiers, names] for (scan_code, modifiers), names in to_name.items() if names],
+        'from_name': [[name, entries] for name, entries in from_name.items() if entries],
+        'keypad_scan_codes': sorted(keypad_scan_codes),
+    }
+    directory = os.path.dirname(tables_cache_path)
+    # Only create missing directories under one owned by us.
+    parent = directory
+    while parent and not os.path.isdir(parent):
+        parent = os.path.dirname(parent)
+    if parent != directory and not (parent and is_owned(parent)):
+        return
+    # Write to a temporary file and rename, so concurrent readers never see a
+    # partial cache. Failing to write (e.g. read-only home) is not an error.
+    temp_path = '{}.{}.tmp'.format(tables_cache_path, os.getpid())
+    try:
+        if parent != directory:
+            os.makedirs(directory, 0o700)
+        if not is_private(directory):
+            return
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.rename(temp_path, tables_cache_path)
+    except (IOError, OSError):
+        try:
+            os.remove(temp_path)
+        except (IOError, OSError):
+            pass
+
+"""
+The listener resolves names for every event, so `to_name` is flattened into
+a list indexed by `scan_code * planes + pressed_modifiers`, where
+`pressed_modifiers` is a bitmask. The four modifiers that select a keymap
+plane use the low bits, so any other modifier being held (e.g. windows)
+makes the mask fall outside the planes and selects the base plane instead,
+just like a missed `to_name` lookup.
+"""
+KEY_CNT = 0x300
+planes = max(modifiers_bits.values()) * 2
+modifier_bits = dict(modifiers_bits)
+for i, modifier in enumerate(sorted(all_modifiers - set(modifiers_bits))):
+    modifier_bits[modifier] = planes << i
+
+names_by_index = []
+modifier_bit_by_index = []
+modifiers_by_mask = [None] * (1 << len(modifier_bits))
+
+def build_name_lookup():
+    names = []
+    for scan_code in range(KEY_CNT):
+        base_name = (to_name.get((scan_code, ())) or ['unknown'])[0]
+        for plane in range(planes):
+            modifiers = tuple(sorted(modifier for modifier, bit in modifiers_bits.items() if plane & bit))
+            names.append((to_name.get((scan_code, modifiers)) or [base_name])[0])
+    names_by_index[:] = names
+    modifier_bit_by_index[:] = [modifier_bits.get(name, 0) for name in names]
+
+def get_modifiers_tuple(mask):
+    modifiers = modifiers_by_mask[mask]
+    if modifiers is None:
+        modifiers = modifiers_by_mask[mask] = tuple(sorted(modifier for modifier, bit in modifier_bits.items() if mask & bit))
+    return modifiers
+
+def get_name_index(scan_code, mask):
+    """ Index in `names_by_index`, or None for scan codes out of range. """
+    if 0 <= scan_code < KEY_CNT:
+        return scan_code * planes + (mask if mask < planes else 0)
+    return None
+
 device = None
 def build_device():
     global device
     if device: return
     ensure_root()
     device = aggregate_devices('kbd')
+    device.set_event_mask({EV_KEY: None})
+
+def get_drop_count():
+    """ Number of times the kernel dropped events, see `EventDevice.drop_count`. """
+    return device.drop_count if device is not None else 0
 
 def init():
     build_device()
     build_tables()
-
-pressed_modifiers = set()
+    return read_pressed_events()
+
+# Bitmask of `modifier_bits`.
+pressed_modifiers = 0
+# Scan codes held down on each device, by device path.
+pressed_keys = defaultdict(set)
+
+def read_pressed_events():
+    """
+    Reads the key state of every device and returns KEY_DOWN events for keys
+    that are already held, also seeding `pressed_keys` and
+    `pressed_modifiers`. Without this, keys pressed before the listener
+    started would only be known after being released and pressed again.
+    """
+    global pressed_modifiers
+    time = now()
+    held = []
+    for event_device in getattr(device, 'devices', [device]):
+        try:
+            scan_codes = event_device.get_pressed_keys()
+        except (IOError, OSError):
+            continue
+        pressed_keys[event_device.path].update(scan_codes)
+        for scan_code in sorted(scan_codes):
+            index = get_name_index(scan_code, 0)
+            if index is not None:
+                pressed_modifiers |= modifier_bit_by_index[index]
+            held.append((scan_code, event_device.path))
+
+    pressed_modifiers_tuple = get_modifiers_tuple(pressed_modifiers)
+    events = []
+    for scan_code, device_id in held:
+        index = get_name_index(scan_code, pressed_modifiers)
+        name = 'unknown' if index is None else names_by_index[index]
+        is_keypad = scan_code in keypad_scan_codes
+        events.append(KeyboardEvent(event_type=KEY_DOWN, scan_code=scan_code, name=name, time=time, device=device_id, is_keypad=is_keypad, modifiers=pressed_modifiers_tuple))
+    return events
+
+def resync(time, device_id, handle_key):
+    """
+    Called when the kernel dropped events from a device, e.g. because the
+    listener was stalled. Reads the actual key state of that device and feeds
+    the missing key ups and downs to `handle_key`, so pressed keys and
+    modifiers don't get stuck. Returns False if the state couldn't be read.
+    """
+    try:
+        actual = device.get_device(device_id).get_pressed_keys()
+    except (AttributeError, IOError, OSError):
+        return False
+    expected = pressed_keys[device_id]
+    for scan_code in sorted(expected - actual):
+        handle_key(time, scan_code, 0, device_id)
+    for scan_code in sorted(actual - expected):
+        handle_key(time, scan_code, 1, device_id)
+    return True
 
 def listen(callback):
     build_device()
     build_tables()
 
-    while True:
-        time, type, code, value, device_id = device.read_event()
-        if type != EV_KEY:
-            continue
+    names = names_by_index
+    modifier_bits = modifier_bit_by_index
 
-        scan_code = code
+    def handle_key(time, scan_code, value, device_id):
+        global pressed_modifiers
         event_type = KEY_DOWN if value else KEY_UP # 0 = UP, 1 = DOWN, 2 = HOLD
 
-        pressed_modifiers_tuple = tuple(sorted(pressed_modifiers))
-        names = to_name[(scan_code, pressed_modifiers_tuple)] or to_name[(scan_code, ())] or ['unknown']
-        name = names[0]
-            
-        if name in all_modifiers:
-            if event_type == KEY_DOWN:
-                pressed_modifiers.add(name)
-            else:
-                pressed_modifiers.discard(name)
+        mask = pressed_modifiers
+        pressed_modifiers_tuple = modifiers_by_mask[mask]
+        if pressed_modifiers_tuple is None:
+            pressed_modifiers_tuple = get_modifiers_tuple(mask)
+        if 0 <= scan_code < KEY_CNT:
+            index = scan_code * planes + (mask if mask < planes else 0)
+            name = names[index]
+            bit = modifier_bits[index]
+            if bit:
+                if event_type == KEY_DOWN:
+                    pressed_modifiers = mask | bit
+                else:
+                    pressed_modifiers = mask & ~bit
+        else:
+            name = 'unknown'
+
+        if event_type == KEY_DOWN:
+            pressed_keys[device_id].add(scan_code)
+        else:
+            pressed_keys[device_id].discard(scan_code)
 
         is_keypad = scan_code in keypad_scan_codes
-        callback(KeyboardEvent(event_type=event_type, scan_code=scan_code, name=name, time=time, device=device_id, is_keypad=is_keypad, modifiers=pressed_modifiers_tuple))
+        callback(KeyboardEvent._from_trusted(event_type, scan_code, name, time, device_id, pressed_modifiers_tuple, is_keypad))
+
+    def handle_events(events):
+        # Devices whose state was read after this batch, so it already
+        # includes their remaining key events.
+        resynced = set()
+        for time, type, code, value, device_id in events:
+            if type == EV_KEY:
+                if device_id not in resynced:
+                    handle_key(time, code, value, device_id)
+            elif type == EV_SYN and code == SYN_DROPPED:
+                if resync(time, device_id, handle_key):
+                    resynced.add(device_id)
+
+    device.listen(handle_events)
 
 def write_event(scan_code, is_down):
     build_device()
@@ -70,35 +70,38 @@ def build_device():
     if device: return
     ensure_root()
     device = aggregate_devices('mouse')
+    device.set_event_mask({EV_KEY: None, EV_REL: (REL_X, REL_Y, REL_WHEEL)})
 init = build_device
 
 def listen(queue):
     build_device()
 
-    while True:
-        time, type, code, value, device_id = device.read_event()
-        if type == EV_SYN or type == EV_MSC:
-            continue
+    def handle_events(events):
+        for time, type, code, value, device_id in events:
+            if type == EV_SYN or type == EV_MSC:
+                continue
 
-        event = None
-        arg = None
+            event = None
+            arg = None
 
-        if type == EV_KEY:
-            event = ButtonEvent(DOWN if value else UP, button_by_code.get(code, '?'), time)
-        elif type == EV_REL:
-            value, = struct.unpack('i', struct.pack('I', value))
+            if type == EV_KEY:
+                event = ButtonEvent(DOWN if value else UP, button_by_code.get(code, '?'), time)
+            elif type == EV_REL:
+                value, = struct.unpack('i', struct.pack('I', value))
 
-            if code == REL_WHEEL:
-                event = WheelEvent(value, time)
-            elif code in (REL_X, REL_Y):
-                x, y = get_position()
-                event = MoveEvent(x, y, time)
+                if code == REL_WHEEL:
+                    event = WheelEvent(value, time)
+                elif code in (REL_X, REL_Y):
+                    x, y = get_position()
+                    event = MoveEvent(x, y, time)
 
-        if event is None:
-            # Unknown event type.
-            continue
+            if event is None:
+                # Unknown event type.
+                continue
 
-        queue.put(event)
+            queue.put(event)
+
+    device.listen(handle_events)
 
 def press(button=LEFT):
     build_device()
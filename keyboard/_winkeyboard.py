@@ -333,6 +333,9 @@ tables_lock = Lock()
 to_name = defaultdict(list)
 from_name = defaultdict(list)
 scan_code_to_vk = {}
+# Incremented every time the tables are built, so anything derived from them
+# (like parsed hotkeys) can be invalidated.
+keymap_generation = 0
 
 distinct_modifiers = [
     (),
@@ -435,6 +438,9 @@ def _setup_name_tables():
     for name, entries in list(from_name.items()):
         from_name[name] = sorted(set(entries), key=order_key)
 
+    global keymap_generation
+    keymap_generation += 1
+
 # Called by keyboard/__init__.py
 init = _setup_name_tables
 
@@ -28,7 +28,11 @@ class _MouseListener(_GenericListener):
                 _pressed_events.discard(event.button)
             else:
                 _pressed_events.add(event.button)
-        return True
+        return event
+
+    def repeat_key(self, event):
+        # Consecutive moves are repeats.
+        return 'move', isinstance(event, MoveEvent)
 
     def listen(self):
         _os_mouse.listen(self.queue)
@@ -183,7 +187,22 @@ def unhook_all():
     Removes all hooks registered by this application. Note this may include
     hooks installed by high level functions, such as `record`.
     """
-    del _listener.handlers[:]
+    _listener.remove_all_handlers()
+
+def configure_queue(maxsize=0, policy='block'):
+    """
+    Limits the events waiting for hooks to `maxsize` (0 for no limit). See
+    `keyboard.configure_queue` for the policies, except 'coalesce' replaces
+    the waiting move with the latest one instead of coalescing key repeats.
+
+    Note: `is_pressed` is updated from the same queue, so dropped button
+    events may leave it wrong.
+    """
+    _listener.queue.configure(maxsize, policy)
+
+def queue_stats():
+    """ Returns a dict with the size and drop counters of the event queue. """
+    return _listener.queue.stats()
 
 def record(button=RIGHT, target_types=(DOWN,)):
     """